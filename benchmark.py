@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import sd_engine as app
+
+# Benchmarks the ingest pipeline without a camera or a NAS: a synthetic card
+# is uploaded with upload_files into a local directory standing in for the
+# SMB share, optionally behind injected latency and a bandwidth cap.
+#
+#   python benchmark.py --scale 0.05 --latency-ms 2 --bandwidth-mbps 110
+#
+# Scenarios: cold (empty database and share), warm (the same card again, so
+# every file is already uploaded) and resume (the link drops partway through,
+# then the card is ingested again and picks up from the last checkpoint).
+# "Cold" means cold for the uploader's own state; the OS page cache is not
+# dropped.
+MB = 1024 * 1024
+
+# --- SYNTHETIC CARD ---
+# Sizes are jittered +-20% around the base size. Every file starts with its
+# own header, so no two files share a hash or a sample hash; the rest is cut
+# from a seeded random pool, so the data does not compress.
+def card_layout(args):
+    rng = random.Random(args.seed)
+    files = []
+    for count, size_mb, folder, pattern in (
+        (args.jpegs, args.jpeg_mb, "DCIM/100MSDCF", "DSC{:05d}.JPG"),
+        (args.arws, args.arw_mb, "DCIM/100MSDCF", "DSC{:05d}.ARW"),
+        (args.mp4s, args.mp4_mb, "PRIVATE/M4ROOT/CLIP", "C{:04d}.MP4"),
+    ):
+        for i in range(count):
+            size = max(1, int(size_mb * args.scale * MB * rng.uniform(0.8, 1.2)))
+            files.append((f"{folder}/{pattern.format(i + 1)}", size))
+    return files
+
+def write_card(card, files, seed):
+    pool = random.Random(seed).randbytes(16 * MB)
+    block = 4 * MB
+    for index, (rel_path, size) in enumerate(files):
+        path = os.path.join(card, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            header = f"{rel_path}:{seed}:{index}\n".encode()
+            f.write(header[:size])
+            written = len(header[:size])
+            part = 0
+            while written < size:
+                n = min(block, size - written)
+                start = (index * 7919 + part * 104729) % (len(pool) - n + 1)
+                f.write(pool[start:start + n])
+                written += n
+                part += 1
+
+def prepare_card(workdir, args, log):
+    card = os.path.join(workdir, "card")
+    files = card_layout(args)
+    spec = {'seed': args.seed, 'files': files}
+    spec_path = os.path.join(workdir, "card.json")
+    try:
+        with open(spec_path) as f:
+            if json.load(f) == json.loads(json.dumps(spec)):
+                log(f"Reusing card at {card}")
+                return card, files
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    shutil.rmtree(card, ignore_errors=True)
+    total = sum(size for _, size in files)
+    log(f"Writing card: {len(files)} files, {total / MB:.1f}MB")
+    write_card(card, files, args.seed)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    return card, files
+
+# --- THROTTLED DESTINATION ---
+# Every round trip (open, mkdir, rename, write) sleeps for the latency; writes
+# also queue on one shared link of the given bandwidth. fail_after makes every
+# write past that many bytes raise, the way a dropped connection would.
+def make_destination_class(app):
+    class ThrottledHandle:
+        def __init__(self, handle, destination):
+            self.handle = handle
+            self.destination = destination
+
+        def write_at(self, data, offset):
+            self.destination.transfer(len(data))
+            self.handle.write_at(data, offset)
+
+        def close(self):
+            self.handle.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+    class ThrottledDestination(app.LocalDestination):
+        def __init__(self, root, latency=0.0, bandwidth=None, fail_after=None):
+            super().__init__(root)
+            self.latency = latency
+            self.bandwidth = bandwidth
+            self.fail_after = fail_after
+            self.sent = 0
+            self.link_free = 0.0
+            self.lock = threading.Lock()
+
+        def round_trip(self):
+            if self.latency:
+                time.sleep(self.latency)
+
+        def transfer(self, nbytes):
+            with self.lock:
+                if self.fail_after is not None and self.sent + nbytes > self.fail_after:
+                    raise ConnectionError("benchmark: link dropped")
+                self.sent += nbytes
+                done = None
+                if self.bandwidth:
+                    start = max(time.monotonic(), self.link_free)
+                    self.link_free = done = start + nbytes / self.bandwidth
+            self.round_trip()
+            if done is not None:
+                time.sleep(max(0.0, done - time.monotonic()))
+
+        def create_dirs(self, path):
+            self.round_trip()
+            super().create_dirs(path)
+
+        def open_write(self, path, resume=False):
+            self.round_trip()
+            return ThrottledHandle(super().open_write(path, resume), self)
+
+        def read_range(self, path, offset, length):
+            self.round_trip()
+            return super().read_range(path, offset, length)
+
+        def getsize(self, path):
+            self.round_trip()
+            return super().getsize(path)
+
+        def replace(self, src, dst):
+            self.round_trip()
+            super().replace(src, dst)
+
+        def remove(self, path):
+            self.round_trip()
+            super().remove(path)
+
+    return ThrottledDestination
+
+# --- RUNS ---
+def use_database(app, path):
+    # A fresh writer per database; the previous one is flushed and left idle.
+    app.flush_db()
+    app.DB_PATH = path
+    app.db_writer = None
+
+def run_once(app, name, card, destination, log):
+    counters = app.Progress()
+    metrics = app.Metrics()
+    start = time.perf_counter()
+    summary = app.upload_files(card, log, counters, lambda manifest: None, [destination], None, metrics)
+    elapsed = time.perf_counter() - start
+    summary = summary or app.new_summary()
+    # Files already known at scan time only show up in the counters.
+    totals = counters.snapshot()
+    processed = totals['uploaded'] + totals['skipped']
+    return {
+        'name': name,
+        'seconds': elapsed,
+        'uploaded': totals['uploaded'],
+        'skipped': totals['skipped'],
+        'failed': totals['failed'],
+        'mb': summary['bytes'] / MB,
+        'files_per_s': processed / elapsed if elapsed else 0.0,
+        'mb_per_s': summary['bytes'] / MB / elapsed if elapsed else 0.0,
+        'stages': metrics.snapshot(),
+    }
+
+def fresh_state(app, workdir, name):
+    share = os.path.join(workdir, f"share-{name}")
+    shutil.rmtree(share, ignore_errors=True)
+    db_path = os.path.join(workdir, f"{name}.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    use_database(app, db_path)
+    return share
+
+def run_scenarios(app, args, workdir, card, total_bytes, log):
+    Destination = make_destination_class(app)
+    latency = args.latency_ms / 1000
+    bandwidth = args.bandwidth_mbps * MB if args.bandwidth_mbps else None
+    results = []
+
+    if args.scenarios & {'cold', 'warm'}:
+        share = fresh_state(app, workdir, 'cold')
+        cold = run_once(app, 'cold', card, Destination(share, latency, bandwidth), log)
+        if 'cold' in args.scenarios:
+            results.append(cold)
+        if 'warm' in args.scenarios:
+            results.append(run_once(app, 'warm', card, Destination(share, latency, bandwidth), log))
+
+    if 'resume' in args.scenarios:
+        # Only files past RESUME_CHECKPOINT_BYTES (64MB) have a checkpoint to resume from.
+        share = fresh_state(app, workdir, 'resume')
+        fail_after = int(total_bytes * args.interrupt_at)
+        results.append(run_once(app, 'interrupted', card, Destination(share, latency, bandwidth, fail_after), log))
+        results.append(run_once(app, 'resume', card, Destination(share, latency, bandwidth), log))
+    return results
+
+# --- REPORT ---
+def print_report(results):
+    print(f"{'run':<12}{'seconds':>10}{'uploaded':>10}{'skipped':>9}{'failed':>8}{'MB':>10}{'files/s':>10}{'MB/s':>9}")
+    for result in results:
+        print(f"{result['name']:<12}{result['seconds']:>10.2f}{result['uploaded']:>10}{result['skipped']:>9}{result['failed']:>8}"
+              f"{result['mb']:>10.1f}{result['files_per_s']:>10.1f}{result['mb_per_s']:>9.1f}")
+    for result in results:
+        print(f"\n{result['name']} stages:")
+        print(f"  {'stage':<11}{'ops':>8}{'MB':>10}{'seconds':>10}{'mean ms':>10}")
+        for stage, stats in result['stages'].items():
+            if not stats['count']:
+                continue
+            mean = stats['seconds'] / stats['count'] * 1000
+            print(f"  {stage:<11}{stats['count']:>8}{stats['bytes'] / MB:>10.1f}{stats['seconds']:>10.2f}{mean:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SD card ingest against a local stand-in for the SMB share.")
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), "sd_uploader_bench"))
+    parser.add_argument('--jpegs', type=int, default=300)
+    parser.add_argument('--arws', type=int, default=120)
+    parser.add_argument('--mp4s', type=int, default=2)
+    parser.add_argument('--jpeg-mb', type=float, default=8)
+    parser.add_argument('--arw-mb', type=float, default=25)
+    parser.add_argument('--mp4-mb', type=float, default=2048)
+    parser.add_argument('--scale', type=float, default=1.0, help="multiplies every file size")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="added to every remote round trip")
+    parser.add_argument('--bandwidth-mbps', type=float, default=0.0, help="shared link cap in MB/s (0 = unlimited)")
+    parser.add_argument('--interrupt-at', type=float, default=0.5, help="fraction of the card sent before the link drops")
+    parser.add_argument('--scenarios', default="cold,warm,resume")
+    parser.add_argument('--hash-algorithm', choices=("sha256", "blake2b", "xxh3"))
+    parser.add_argument('--upload-limit-mbps', type=float, default=0.0, help="the uploader's own cap in MB/s (0 = none)")
+    parser.add_argument('--verify-mode', choices=("off", "size", "sampled", "full"))
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    args.scenarios = set(args.scenarios.split(','))
+
+    def log(message):
+        if args.verbose:
+            print(message, flush=True)
+
+    workdir = os.path.abspath(args.workdir)
+    os.makedirs(workdir, exist_ok=True)
+    json_path = os.path.abspath(args.json) if args.json else None
+    # The engine keeps its database and log in the working directory.
+    os.chdir(workdir)
+    app.ALLOWED_EXTENSIONS = {".JPG": True, ".JPEG": True, ".ARW": True, ".MP4": True}
+    app.METRICS_FILE = ""
+    if args.hash_algorithm:
+        app.HASH_ALGORITHM = args.hash_algorithm
+    app.BANDWIDTH_LIMIT = int(args.upload_limit_mbps * MB)
+    if args.verify_mode:
+        app.VERIFY_MODE = args.verify_mode
+
+    card, files = prepare_card(workdir, args, lambda message: print(message, flush=True))
+    total_bytes = sum(size for _, size in files)
+    results = run_scenarios(app, args, workdir, card, total_bytes, log)
+    app.flush_db()
+    print_report(results)
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({'version': app.APP_VERSION, 'args': {k: sorted(v) if isinstance(v, set) else v for k, v in vars(args).items()},
+                       'results': results}, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2732 @@
+import smbclient
+from smbprotocol.open import FilePipePrinterAccessMask
+import os
+import hashlib
+import math
+import shutil
+import sqlite3
+import time
+import sys
+import json
+import errno
+import struct
+import random
+import bisect
+import itertools
+import re
+import select
+import signal
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import threading
+import queue
+import logging
+from collections import deque
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# The ingest engine: settings, the share, the database, hashing, dedup, the
+# upload pipeline and card sessions. Nothing here imports a GUI toolkit, so
+# the headless entry point and the benchmark load it without Tk or the tray.
+
+# Load settings from settings.json
+SETTINGS_FILE = 'settings.json'
+DEFAULT_SETTINGS = {
+    "SD_LABEL": "F:\\",
+    "SD_LABELS": [],
+    "CARD_WATCHER": "auto",
+    "SMB_SERVER": "192.168.1.254",
+    "SMB_SHARE": "Media/Path",
+    "SMB_USER": "user",
+    "SMB_PASS": "pass",
+    "DESTINATIONS": [],
+    "ALLOWED_EXTENSIONS": {".ARW": True, ".JPEG": True, ".MP4": False},
+    "HASH_ALGORITHM": "sha256",
+    "CHUNK_SIZE_MB": 4,
+    "WRITES_IN_FLIGHT": 3,
+    "READ_AHEAD_MB": 64,
+    "NET_WORKERS": 8,
+    "LARGE_FILE_MB": 1024,
+    "WATCH_MODE": False,
+    "METRICS_FILE": "",
+    "METRICS_FORMAT": "json",
+    "VERIFY_MODE": "size",
+    "BANDWIDTH_LIMIT_MBPS": 0,
+    "BANDWIDTH_SCHEDULE": [],
+    "SMALL_FILE_PRIORITY_MB": 0
+}
+def load_settings():
+    global SD_LABEL, SMB_SERVER, SMB_SHARE, SMB_USER, SMB_PASS, ALLOWED_EXTENSIONS, HASH_ALGORITHM, CHUNK_SIZE, WRITES_IN_FLIGHT
+    global READ_AHEAD_BYTES, NET_WORKERS, LARGE_FILE_BYTES, SD_LABELS, CARD_WATCHER, WATCH_MODE
+    global METRICS_FILE, METRICS_FORMAT, VERIFY_MODE, DESTINATIONS, settings_mtime
+    try:
+        with open(SETTINGS_FILE, 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        data = DEFAULT_SETTINGS
+        with open(SETTINGS_FILE, 'w') as f:
+            json.dump(DEFAULT_SETTINGS, f, indent=4)
+    SD_LABEL = data.get('SD_LABEL', DEFAULT_SETTINGS['SD_LABEL'])
+    SD_LABELS = list(data.get('SD_LABELS', DEFAULT_SETTINGS['SD_LABELS']))
+    CARD_WATCHER = data.get('CARD_WATCHER', DEFAULT_SETTINGS['CARD_WATCHER'])
+    SMB_SERVER = data.get('SMB_SERVER', DEFAULT_SETTINGS['SMB_SERVER'])
+    SMB_SHARE = data.get('SMB_SHARE', DEFAULT_SETTINGS['SMB_SHARE'])
+    SMB_USER = data.get('SMB_USER', DEFAULT_SETTINGS['SMB_USER'])
+    SMB_PASS = data.get('SMB_PASS', DEFAULT_SETTINGS['SMB_PASS'])
+    DESTINATIONS = list(data.get('DESTINATIONS', DEFAULT_SETTINGS['DESTINATIONS']))
+    ALLOWED_EXTENSIONS = data.get('ALLOWED_EXTENSIONS', DEFAULT_SETTINGS['ALLOWED_EXTENSIONS'])
+    HASH_ALGORITHM = data.get('HASH_ALGORITHM', DEFAULT_SETTINGS['HASH_ALGORITHM'])
+    CHUNK_SIZE = int(data.get('CHUNK_SIZE_MB', DEFAULT_SETTINGS['CHUNK_SIZE_MB']) * 1024 * 1024)
+    WRITES_IN_FLIGHT = max(1, int(data.get('WRITES_IN_FLIGHT', DEFAULT_SETTINGS['WRITES_IN_FLIGHT'])))
+    READ_AHEAD_BYTES = int(data.get('READ_AHEAD_MB', DEFAULT_SETTINGS['READ_AHEAD_MB']) * 1024 * 1024)
+    NET_WORKERS = max(1, int(data.get('NET_WORKERS', DEFAULT_SETTINGS['NET_WORKERS'])))
+    LARGE_FILE_BYTES = int(data.get('LARGE_FILE_MB', DEFAULT_SETTINGS['LARGE_FILE_MB']) * 1024 * 1024)
+    WATCH_MODE = bool(data.get('WATCH_MODE', DEFAULT_SETTINGS['WATCH_MODE']))
+    METRICS_FILE = data.get('METRICS_FILE', DEFAULT_SETTINGS['METRICS_FILE'])
+    METRICS_FORMAT = data.get('METRICS_FORMAT', DEFAULT_SETTINGS['METRICS_FORMAT'])
+    VERIFY_MODE = data.get('VERIFY_MODE', DEFAULT_SETTINGS['VERIFY_MODE'])
+    apply_bandwidth_settings(data)
+    try:
+        settings_mtime = os.stat(SETTINGS_FILE).st_mtime
+    except OSError:
+        pass
+
+# The bandwidth settings are the only ones a running session picks up when
+# settings.json changes; see reload_bandwidth_settings.
+def apply_bandwidth_settings(data):
+    global BANDWIDTH_LIMIT, BANDWIDTH_SCHEDULE, SMALL_FILE_PRIORITY_BYTES
+    BANDWIDTH_LIMIT = int(float(data.get('BANDWIDTH_LIMIT_MBPS', DEFAULT_SETTINGS['BANDWIDTH_LIMIT_MBPS'])) * 1024 * 1024)
+    BANDWIDTH_SCHEDULE = parse_bandwidth_schedule(data.get('BANDWIDTH_SCHEDULE', DEFAULT_SETTINGS['BANDWIDTH_SCHEDULE']))
+    SMALL_FILE_PRIORITY_BYTES = int(float(data.get('SMALL_FILE_PRIORITY_MB', DEFAULT_SETTINGS['SMALL_FILE_PRIORITY_MB'])) * 1024 * 1024)
+APP_VERSION = "1.0.4"
+
+# --- CONFIG ---
+SD_LABEL = "F:\\"
+SD_LABELS = []  # extra card readers watched alongside SD_LABEL
+CARD_WATCHER = "auto"  # auto (mount events where available) or poll
+CARD_POLL_INTERVAL = 1.0
+SMB_SERVER = "192.168.1.254"
+SMB_SHARE = "Media/Path"
+SMB_USER = "user"
+SMB_PASS = "pass"
+DESTINATIONS = []  # backup copies: {"server", "share", "user", "pass"} or {"path"} each
+DESTINATION_LAG_SECONDS = 2.0
+BANDWIDTH_LIMIT = 0  # bytes per second across all uploads; 0 means no limit
+BANDWIDTH_SCHEDULE = []  # (days, start minute, end minute, bytes per second), first match wins
+BANDWIDTH_BURST_SECONDS = 0.25
+BANDWIDTH_CHECK_INTERVAL = 1.0
+SMALL_FILE_PRIORITY_BYTES = 0  # files under this size go first while the limit holds uploads back
+DB_PATH = "uploaded_files.db"
+LOG_FILE = "sd_uploader.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_RING_LINES = 2000
+METRICS_FILE = ""  # empty disables the per-session metrics export
+METRICS_FORMAT = "json"  # json (one line per session) or prometheus
+ETA_HALFLIFE = 10.0
+STATUS_INTERVAL = 5.0
+HASH_CACHE_MAX_ENTRIES = 200000
+CHUNK_SIZE = 4 * 1024 * 1024
+WRITES_IN_FLIGHT = 3
+READ_AHEAD_BYTES = 64 * 1024 * 1024  # card read buffers shared by all uploads of one card
+STREAM_READ_AHEAD = 2  # chunks read ahead per file before the reader moves on
+NET_WORKERS = 8
+LARGE_FILE_BYTES = 1024 * 1024 * 1024
+TUNE_INTERVAL = 2.0
+WORK_QUEUE_SIZE = 32
+WATCH_MODE = False  # keep uploading new files while the card stays mounted
+WATCH_INTERVAL = 1.0
+WATCH_STABLE_SECONDS = 2.0
+WATCH_MTIME_SLACK = 2.0
+# Upload order within a card: previews first, then raw files, then video.
+EXTENSION_ORDER = {".JPG": 0, ".JPEG": 0, ".HEIC": 0, ".ARW": 1, ".MP4": 2, ".MOV": 2}
+SAMPLE_BLOCK = 64 * 1024
+DB_COMMIT_BATCH = 256
+DB_COMMIT_INTERVAL = 0.5
+RESUME_CHECKPOINT_BYTES = 64 * 1024 * 1024
+RESUME_MAX_AGE_DAYS = 7
+VERIFY_MODE = "size"  # off, size, sampled (VERIFY_SAMPLES blocks read back) or full
+VERIFY_SAMPLES = 4
+VERIFY_RETRIES = 2
+MANIFEST_PATH = ".sd_uploader/manifest.bin"
+MANIFEST_BATCH = 64
+SCHEMA_VERSION = 8
+ALLOWED_EXTENSIONS = {".ARW": True, ".JPEG": True, ".MP4": False}
+HASH_ALGORITHM = "sha256"  # sha256, blake2b, or xxh3 (needs the xxhash package)
+
+# --- STORAGE CALC ---
+def get_local_free_space(path):
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+def get_file_size(path):
+    return os.path.getsize(path)
+
+def get_total_upload_size(manifest, status='pending'):
+    return sum(entry['size'] for entry in manifest if entry['status'] == status)
+
+def estimate_smb_free_space(remote_path):
+    try:
+        return smbclient.stat_volume(remote_path).caller_available_size
+    except Exception:
+        return float('inf')  # Assume enough if can't determine
+
+# --- DESTINATIONS ---
+# A destination owns everything about where files land. The SMB one registers
+# its session once (smbclient then reuses the connection and tree connect for
+# every file), remembers which directories it has already created, and writes
+# chunks at explicit offsets so several writes per file can be in flight on
+# the same handle. LocalDestination has the same interface over a local
+# directory and stands in for the share in tests and benchmarks.
+class SMBWriteHandle:
+    def __init__(self, path, resume=False):
+        self.file = smbclient.open_file(path, mode='r+b' if resume else 'wb', buffering=0)
+
+    def write_at(self, data, offset):
+        fd = self.file.fd
+        max_write = fd.connection.max_write_size
+        for pos in range(0, len(data), max_write):
+            fd.write(bytes(data[pos:pos + max_write]), offset + pos)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class LocalWriteHandle:
+    def __init__(self, path, resume=False):
+        self.file = open(path, 'r+b' if resume else 'wb', buffering=0)
+        self.lock = threading.Lock()
+
+    def write_at(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            os.pwrite(self.file.fileno(), data, offset)
+            return
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Destination:
+    def __init__(self, root):
+        self.root = root.rstrip('/')
+        self.created_dirs = set()
+
+    def join(self, *parts):
+        return '/'.join([self.root] + [part.strip('/') for part in parts])
+
+    def makedirs(self, path):
+        if path not in self.created_dirs:
+            self.create_dirs(path)
+            self.created_dirs.add(path)
+
+class SMBDestination(Destination):
+    def __init__(self, server, share, username, password):
+        super().__init__(f"//{server}/{share}")
+        self.server = server
+        self.username = username
+        self.password = password
+
+    def connect(self):
+        smbclient.register_session(server=self.server, username=self.username, password=self.password)
+
+    def create_dirs(self, path):
+        smbclient.makedirs(path, exist_ok=True)
+
+    def open_write(self, path, resume=False):
+        return SMBWriteHandle(path, resume)
+
+    def read_range(self, path, offset, length):
+        with smbclient.open_file(path, mode='rb', share_access='rw') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def open_read(self, path):
+        return smbclient.open_file(path, mode='rb', buffering=0, share_access='rw')
+
+    def getsize(self, path):
+        return smbclient.stat(path).st_size
+
+    def stat(self, path):
+        try:
+            st = smbclient.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def write_new(self, path, data):
+        with smbclient.open_file(path, mode='xb') as f:
+            f.write(data)
+
+    def append(self, path, data):
+        # Append-only access with the all-ones offset makes the server put the
+        # write at the current end of file, so stations appending at the same
+        # time never overwrite each other.
+        access = FilePipePrinterAccessMask.FILE_APPEND_DATA | FilePipePrinterAccessMask.SYNCHRONIZE
+        with smbclient.open_file(path, mode='ab', buffering=0, share_access='rw', desired_access=access) as f:
+            f.fd.write(bytes(data), 0xFFFFFFFFFFFFFFFF)
+
+    def replace(self, src, dst):
+        smbclient.replace(src, dst)
+
+    def rename(self, src, dst):
+        # Unlike replace, never overwrites dst.
+        try:
+            smbclient.rename(src, dst)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise FileExistsError(dst) from e
+            raise
+
+    def remove(self, path):
+        smbclient.remove(path)
+
+    def free_space(self, path):
+        # The dated folder may not exist yet; the share root is on the same volume.
+        return estimate_smb_free_space(self.root)
+
+class LocalDestination(Destination):
+    def connect(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    def create_dirs(self, path):
+        os.makedirs(path, exist_ok=True)
+
+    def open_write(self, path, resume=False):
+        return LocalWriteHandle(path, resume)
+
+    def read_range(self, path, offset, length):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def open_read(self, path):
+        return open(path, 'rb', buffering=0)
+
+    def getsize(self, path):
+        return os.path.getsize(path)
+
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def write_new(self, path, data):
+        with open(path, 'xb') as f:
+            f.write(data)
+
+    def append(self, path, data):
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+    def rename(self, src, dst):
+        # Unlike replace, never overwrites dst. Windows refuses on its own;
+        # elsewhere a hard link fails if dst exists.
+        if os.name == 'nt':
+            os.rename(src, dst)
+            return
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            raise
+        except OSError:
+            # Filesystems without hard links (FAT) can only check first.
+            if os.path.lexists(dst):
+                raise FileExistsError(dst)
+            os.rename(src, dst)
+            return
+        os.remove(src)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def free_space(self, path):
+        try:
+            return shutil.disk_usage(self.root).free
+        except OSError:
+            return float('inf')
+
+destination_cache = {}
+
+def get_destinations():
+    # The primary share first, then DESTINATIONS. Each is built once per set
+    # of settings, so its directory cache survives between cards.
+    specs = [{'server': SMB_SERVER, 'share': SMB_SHARE, 'user': SMB_USER, 'pass': SMB_PASS}] + DESTINATIONS
+    destinations = {}
+    for spec in specs:
+        key = json.dumps(spec, sort_keys=True)
+        if key not in destination_cache:
+            if 'path' in spec:
+                destination_cache[key] = LocalDestination(spec['path'])
+            else:
+                destination_cache[key] = SMBDestination(spec['server'], spec['share'], spec.get('user', SMB_USER), spec.get('pass', SMB_PASS))
+        destinations.setdefault(destination_cache[key].root, destination_cache[key])
+    return list(destinations.values())
+
+# One session's view of the destinations. The first one that connects leads:
+# resumable uploads, verification, the share manifest and uploaded_files all
+# follow it. The others are mirrors that receive the same chunks as they are
+# read. A mirror that is unreachable, fails, or holds the lead up for more
+# than DESTINATION_LAG_SECONDS in total is dropped for the rest of the
+# session; what it missed stays in destination_copies and is copied over from
+# another destination afterwards.
+class DestinationSet:
+    def __init__(self, destinations, log_func):
+        self.destinations = destinations
+        self.log_func = log_func
+        self.lead = None
+        self.mirrors = []
+        self.connected = []
+        self.stalled = {}
+        self.finisher = ThreadPoolExecutor(max_workers=NET_WORKERS)
+        self.finishing = []
+        self.lock = threading.Lock()
+        # Pools belong to the session, not the shared destination, so cards in
+        # other readers never queue behind it: every network file can keep
+        # WRITES_IN_FLIGHT chunks moving to each destination. Verify read-backs
+        # get their own pool and never wait behind writes.
+        self.write_pools = {destination.root: ThreadPoolExecutor(max_workers=NET_WORKERS * WRITES_IN_FLIGHT) for destination in destinations}
+        self.verify_pool = ThreadPoolExecutor(max_workers=NET_WORKERS * VERIFY_SAMPLES)
+
+    def connect(self):
+        online = []
+        error = None
+        for destination in self.destinations:
+            try:
+                destination.connect()
+                online.append(destination)
+            except Exception as e:
+                error = error or e
+                self.log_func(f"⚠️ {destination.root} is unreachable ({e}); it will catch up later")
+        if not online:
+            raise error
+        self.connected = online
+        self.lead, self.mirrors = online[0], online[1:]
+        if self.lead is not self.destinations[0]:
+            self.log_func(f"⚠️ Uploading to {self.lead.root} first")
+
+    def active_mirrors(self):
+        with self.lock:
+            return list(self.mirrors)
+
+    def drop(self, destination, reason):
+        with self.lock:
+            if destination not in self.mirrors:
+                return
+            self.mirrors.remove(destination)
+        self.log_func(f"⚠️ {destination.root} dropped for this session ({reason}); it will catch up later")
+
+    def stall(self, destination, seconds):
+        # Returns how much longer the lead may wait for this mirror.
+        with self.lock:
+            self.stalled[destination.root] = self.stalled.get(destination.root, 0.0) + seconds
+            return DESTINATION_LAG_SECONDS - self.stalled[destination.root]
+
+    def finish(self, func, *args):
+        with self.lock:
+            self.finishing.append(self.finisher.submit(func, *args))
+
+    def wait(self):
+        with self.lock:
+            finishing, self.finishing = self.finishing, []
+        wait(finishing)
+
+    def write_pool(self, destination):
+        return self.write_pools[destination.root]
+
+    def close(self):
+        for pool in [self.finisher, self.verify_pool, *self.write_pools.values()]:
+            pool.shutdown(wait=False)
+
+# --- DATABASE WRITER ---
+# A single thread owns the only connection to DB_PATH. Workers queue
+# operations (functions taking the connection) and get a Future back. The
+# writer applies them in order, each inside its own savepoint, and group-commits
+# once DB_COMMIT_BATCH operations or DB_COMMIT_INTERVAL seconds have piled up.
+# Durable operations resolve only after the commit that covers them, and the
+# writer commits as soon as its queue drains while any are waiting.
+class DatabaseWriter:
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, durable=False):
+        future = Future()
+        self.queue.put((func, args, durable, future))
+        return future
+
+    def call(self, func, *args, durable=False):
+        return self.submit(func, *args, durable=durable).result()
+
+    def flush(self):
+        self.call(lambda conn: None, durable=True)
+
+    def run(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        waiting = []
+        uncommitted = 0
+        batch_started = None
+        while True:
+            timeout = None
+            if uncommitted:
+                timeout = max(0, batch_started + DB_COMMIT_INTERVAL - time.monotonic())
+            try:
+                func, args, durable, future = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                func = None
+            if func is not None:
+                if not conn.in_transaction:
+                    conn.execute("BEGIN")
+                    batch_started = time.monotonic()
+                conn.execute("SAVEPOINT op")
+                try:
+                    result = func(conn, *args)
+                    conn.execute("RELEASE op")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    future.set_exception(e)
+                else:
+                    uncommitted += 1
+                    if durable:
+                        waiting.append((future, result))
+                    else:
+                        future.set_result(result)
+            if conn.in_transaction and (func is None
+                                        or uncommitted >= DB_COMMIT_BATCH
+                                        or time.monotonic() - batch_started >= DB_COMMIT_INTERVAL
+                                        or (waiting and self.queue.empty())):
+                conn.execute("COMMIT")
+                uncommitted = 0
+            if waiting and not conn.in_transaction:
+                for future, result in waiting:
+                    future.set_result(result)
+                waiting = []
+
+db_writer = None
+db_writer_lock = threading.Lock()
+
+def get_db():
+    global db_writer
+    with db_writer_lock:
+        if db_writer is None:
+            db_writer = DatabaseWriter(DB_PATH)
+        return db_writer
+
+def flush_db():
+    if db_writer is not None:
+        db_writer.flush()
+
+# --- DATABASE SETUP ---
+# Helpers take the writer's connection and never commit; the writer does that.
+def create_schema(conn):
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS uploaded_files (file_hash TEXT PRIMARY KEY)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS in_progress_uploads (file_hash TEXT PRIMARY KEY, smb_path TEXT)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS hash_cache (volume_id TEXT, rel_path TEXT, size INTEGER, mtime REAL, file_hash TEXT, last_used REAL, PRIMARY KEY (volume_id, rel_path))")
+    cursor.execute("CREATE INDEX IF NOT EXISTS hash_cache_last_used ON hash_cache (last_used)")
+    migrate_db(conn)
+
+def init_db():
+    get_db().call(create_schema, durable=True)
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def migrate_db(conn):
+    cursor = conn.cursor()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        # Streamed uploads only learn their hash at the end, so in-progress rows
+        # are keyed by the remote path, and uploaded rows carry the size pre-key.
+        if 'size' not in table_columns(conn, 'uploaded_files'):
+            cursor.execute("ALTER TABLE uploaded_files ADD COLUMN size INTEGER")
+        cursor.execute("CREATE TABLE in_progress_uploads_new (smb_path TEXT PRIMARY KEY, file_hash TEXT)")
+        cursor.execute("INSERT OR IGNORE INTO in_progress_uploads_new (smb_path, file_hash) SELECT smb_path, file_hash FROM in_progress_uploads")
+        cursor.execute("DROP TABLE in_progress_uploads")
+        cursor.execute("ALTER TABLE in_progress_uploads_new RENAME TO in_progress_uploads")
+    if version < 3:
+        # Existing rows are all SHA-256; their size and sample hash are filled
+        # in the next time a file matches them.
+        cursor.execute("ALTER TABLE uploaded_files ADD COLUMN sample_hash TEXT")
+        cursor.execute("ALTER TABLE uploaded_files ADD COLUMN hash_algo TEXT NOT NULL DEFAULT 'sha256'")
+        cursor.execute("ALTER TABLE hash_cache ADD COLUMN hash_algo TEXT NOT NULL DEFAULT 'sha256'")
+        cursor.execute("DROP INDEX IF EXISTS uploaded_files_size")
+    if version < 4:
+        # Hashes become raw digests in BLOB columns (half the size of hex text),
+        # uploaded_files drops its rowid, and each upload records what it was.
+        conn.create_function('hex_to_blob', 1, hex_to_blob)
+        cursor.execute("CREATE TABLE uploaded_files_new (file_hash BLOB PRIMARY KEY, size INTEGER, sample_hash BLOB, hash_algo TEXT NOT NULL DEFAULT 'sha256', original_name TEXT, remote_path TEXT, uploaded_at REAL) WITHOUT ROWID")
+        cursor.execute("INSERT OR IGNORE INTO uploaded_files_new (file_hash, size, sample_hash, hash_algo) SELECT hex_to_blob(file_hash), size, hex_to_blob(sample_hash), hash_algo FROM uploaded_files")
+        cursor.execute("DROP TABLE uploaded_files")
+        cursor.execute("ALTER TABLE uploaded_files_new RENAME TO uploaded_files")
+        cursor.execute("CREATE TABLE hash_cache_new (volume_id TEXT, rel_path TEXT, size INTEGER, mtime REAL, file_hash BLOB, hash_algo TEXT NOT NULL DEFAULT 'sha256', last_used REAL, PRIMARY KEY (volume_id, rel_path))")
+        cursor.execute("INSERT INTO hash_cache_new SELECT volume_id, rel_path, size, mtime, hex_to_blob(file_hash), hash_algo, last_used FROM hash_cache")
+        cursor.execute("DROP TABLE hash_cache")
+        cursor.execute("ALTER TABLE hash_cache_new RENAME TO hash_cache")
+        cursor.execute("CREATE INDEX IF NOT EXISTS hash_cache_last_used ON hash_cache (last_used)")
+        cursor.execute("UPDATE in_progress_uploads SET file_hash = hex_to_blob(file_hash)")
+    if version < 5:
+        # Resumable uploads: which card file a row belongs to, where its
+        # temporary copy lives, and how far it got. Older rows have no tmp_path
+        # and are cleaned up the old way.
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN tmp_path TEXT")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN volume_id TEXT")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN rel_path TEXT")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN size INTEGER")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN mtime REAL")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN committed_offset INTEGER NOT NULL DEFAULT 0")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN chunk_hash BLOB")
+        cursor.execute("ALTER TABLE in_progress_uploads ADD COLUMN updated_at REAL")
+        cursor.execute("CREATE INDEX IF NOT EXISTS in_progress_source ON in_progress_uploads (volume_id, rel_path)")
+    if version < 6:
+        # How far into each share manifest this database has read.
+        cursor.execute("CREATE TABLE IF NOT EXISTS remote_manifests (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, imported INTEGER)")
+    if version < 7:
+        # Which destinations hold each upload; done=0 rows are still to be copied.
+        cursor.execute("CREATE TABLE IF NOT EXISTS destination_copies (destination TEXT, file_hash BLOB, remote_path TEXT, done INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (destination, file_hash)) WITHOUT ROWID")
+        cursor.execute("CREATE INDEX IF NOT EXISTS destination_copies_pending ON destination_copies (destination, done)")
+    if version < 8:
+        # Looked up when picking a remote name that no destination holds yet.
+        cursor.execute("CREATE INDEX IF NOT EXISTS destination_copies_path ON destination_copies (remote_path)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS uploaded_files_sample ON uploaded_files (size, sample_hash)")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+def hex_to_blob(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return bytes.fromhex(value)
+    except ValueError:
+        return value.encode()
+
+def clear_tables(conn):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM uploaded_files")
+    cursor.execute("DELETE FROM in_progress_uploads")
+    # Forget how much of the share manifest was read, so the next session imports it again.
+    cursor.execute("DELETE FROM remote_manifests")
+    cursor.execute("DELETE FROM destination_copies")
+
+def clear_db():
+    init_db()
+    get_db().call(clear_tables, durable=True)
+
+# Hashing outside the upload path reuses one CHUNK_SIZE buffer per thread;
+# uploads read through the CardReader's pool instead.
+chunk_buffers = threading.local()
+
+def get_chunk_buffers(count):
+    buffers = getattr(chunk_buffers, 'buffers', [])
+    if len(buffers) < count or len(buffers[0]) != CHUNK_SIZE:
+        buffers = chunk_buffers.buffers = [bytearray(CHUNK_SIZE) for _ in range(max(count, len(buffers)))]
+    return buffers[:count]
+
+def read_chunks(f, limit=None):
+    buffer = get_chunk_buffers(1)[0]
+    view = memoryview(buffer)
+    remaining = limit
+    while remaining is None or remaining > 0:
+        n = f.readinto(buffer if remaining is None or remaining >= len(buffer) else view[:remaining])
+        if not n:
+            break
+        if remaining is not None:
+            remaining -= n
+        yield view[:n]
+
+# --- HASHING ---
+def hash_algorithm():
+    if HASH_ALGORITHM == 'xxh3' and xxhash is None:
+        return 'blake2b'
+    if HASH_ALGORITHM not in ('sha256', 'blake2b', 'xxh3'):
+        return 'sha256'
+    return HASH_ALGORITHM
+
+def hash_available(algorithm):
+    return algorithm != 'xxh3' or xxhash is not None
+
+def new_hasher(algorithm):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=32)
+    if algorithm == 'xxh3':
+        return xxhash.xxh3_128()
+    return hashlib.sha256()
+
+def file_hashes(path, algorithms):
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            for chunk in read_chunks(f):
+                for h in hashers.values():
+                    h.update(chunk)
+        return {algorithm: h.digest() for algorithm, h in hashers.items()}
+    except (PermissionError, FileNotFoundError) as e:
+        print(f"❌ Cannot read file: {path} - {e}")
+        return None
+
+def file_hash(path, algorithm=None):
+    algorithm = algorithm or hash_algorithm()
+    hashes = file_hashes(path, [algorithm])
+    return hashes[algorithm] if hashes else None
+
+# The sample hash covers the size plus the first and last SAMPLE_BLOCK bytes.
+# It always uses BLAKE2b so stored samples stay comparable when HASH_ALGORITHM changes.
+def sample_digest(size, head, tail):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(size.to_bytes(8, 'little'))
+    h.update(head)
+    h.update(tail)
+    return h.digest()
+
+class SampleCollector:
+    def __init__(self, size):
+        self.size = size
+        self.tail_start = max(0, size - SAMPLE_BLOCK)
+        self.head = bytearray()
+        self.tail = bytearray()
+
+    def update(self, chunk, offset):
+        if offset < SAMPLE_BLOCK:
+            self.head += chunk[:SAMPLE_BLOCK - offset]
+        if offset + len(chunk) > self.tail_start:
+            self.tail += chunk[max(0, self.tail_start - offset):]
+
+    def digest(self):
+        return sample_digest(self.size, self.head, self.tail)
+
+# Picks up to count SAMPLE_BLOCK-aligned blocks at random, always including
+# the last one, and keeps their digests as the upload reads past them.
+class BlockSampler:
+    def __init__(self, size, count):
+        self.size = size
+        last = (size - 1) // SAMPLE_BLOCK if size else 0
+        picks = set(random.sample(range(last), min(max(count - 1, 0), last)))
+        if count and size:
+            picks.add(last)
+        self.blocks = {index * SAMPLE_BLOCK: bytearray() for index in picks}
+
+    def update(self, chunk, offset):
+        end = offset + len(chunk)
+        for start, data in self.blocks.items():
+            stop = min(start + SAMPLE_BLOCK, self.size)
+            if start < end and offset < stop:
+                data += chunk[max(start - offset, 0):stop - offset]
+
+    def samples(self):
+        return [(start, len(data), chunk_digest(data)) for start, data in sorted(self.blocks.items())]
+
+def chunk_digest(chunk):
+    return hashlib.blake2b(chunk, digest_size=16).digest()
+
+def sample_hash(path, size):
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SAMPLE_BLOCK)
+            f.seek(max(0, size - SAMPLE_BLOCK))
+            tail = f.read(SAMPLE_BLOCK)
+        return sample_digest(size, head, tail)
+    except OSError as e:
+        print(f"❌ Cannot read file: {path} - {e}")
+        return None
+
+# --- HASH CACHE ---
+# Files are identified by (volume, relative path, size, mtime). A matching row
+# means the file has not changed since it was last hashed, so the stored hash
+# is reused without reading the file again.
+def get_volume_id(path):
+    if os.name == 'nt':
+        import ctypes
+        serial = ctypes.c_uint32()
+        drive = os.path.splitdrive(os.path.abspath(path))[0] + "\\"
+        if ctypes.windll.kernel32.GetVolumeInformationW(ctypes.c_wchar_p(drive), None, 0, ctypes.byref(serial), None, None, None, 0):
+            return f"{serial.value:08X}"
+    dev = os.stat(path).st_dev
+    by_uuid = '/dev/disk/by-uuid'
+    if os.path.isdir(by_uuid):
+        for name in os.listdir(by_uuid):
+            try:
+                if os.stat(os.path.join(by_uuid, name)).st_rdev == dev:
+                    return name
+            except OSError:
+                continue
+    return str(dev)
+
+# The scan loads a volume's whole cache in one query instead of a lookup per file.
+def load_hash_cache(conn, volume_id, algorithm):
+    cursor = conn.cursor()
+    cursor.execute("SELECT rel_path, size, mtime, file_hash FROM hash_cache WHERE volume_id=? AND hash_algo=?", (volume_id, algorithm))
+    return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+def lookup_hash_cache(cache, rel_path, size, mtime):
+    row = cache.get(rel_path)
+    if row and row[0] == size and row[1] == mtime:
+        return row[2]
+    return None
+
+def touch_hash_cache(conn, volume_id, rel_paths, last_used):
+    conn.executemany("UPDATE hash_cache SET last_used=? WHERE volume_id=? AND rel_path=?",
+                     ((last_used, volume_id, rel_path) for rel_path in rel_paths))
+
+def store_hash_cache(conn, volume_id, rel_path, size, mtime, hash_val, algorithm):
+    conn.execute("INSERT OR REPLACE INTO hash_cache (volume_id, rel_path, size, mtime, file_hash, hash_algo, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (volume_id, rel_path, size, mtime, hash_val, algorithm, time.time()))
+
+def prune_hash_cache(conn, volume_id, scan_started):
+    # Anything on this volume the scan did not touch was deleted or the card was reformatted.
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM hash_cache WHERE volume_id=? AND last_used < ?", (volume_id, scan_started))
+    cursor.execute("DELETE FROM hash_cache WHERE rowid IN (SELECT rowid FROM hash_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (HASH_CACHE_MAX_ENTRIES,))
+
+def already_uploaded(conn, hash_val):
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM uploaded_files WHERE file_hash=?", (hash_val,))
+    return cursor.fetchone() is not None
+
+def uploaded_path(conn, hash_val):
+    row = conn.execute("SELECT remote_path FROM uploaded_files WHERE file_hash=?", (hash_val,)).fetchone()
+    return row[0] if row else None
+
+def filter_uploaded(conn, hashes):
+    hashes = list(hashes)
+    found = set()
+    for i in range(0, len(hashes), 500):
+        batch = hashes[i:i + 500]
+        cursor = conn.execute(f"SELECT file_hash FROM uploaded_files WHERE file_hash IN ({','.join('?' * len(batch))})", batch)
+        found.update(row[0] for row in cursor)
+    return found
+
+# --- DEDUP INDEX ---
+# Loaded once per session so the common answer, "never uploaded", costs no
+# database round-trip. Bloom filters over hashes, sizes and sample hashes can
+# only give false positives; a positive is confirmed against uploaded_files.
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.bit_count = max(1024, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.lock = threading.Lock()
+
+    def positions(self, key):
+        # Digests are already uniform; anything shorter is hashed first.
+        if len(key) < 16:
+            key = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        with self.lock:
+            for pos in self.positions(key):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(key))
+
+class DedupIndex:
+    def __init__(self, count):
+        capacity = count * 2 + 10000
+        self.hashes = BloomFilter(capacity)
+        self.sizes = BloomFilter(capacity)
+        self.samples = BloomFilter(capacity)
+        # Rows from before the size and sample columns existed stay out of the
+        # size and sample tiers; the scan matches them by content hash instead.
+        self.legacy_algorithms = set()
+
+    def add(self, hash_val, size, sample, algorithm=None):
+        self.hashes.add(hash_val)
+        if size is None or sample is None:
+            if hash_available(algorithm):
+                self.legacy_algorithms.add(algorithm)
+            return
+        self.sizes.add(size.to_bytes(8, 'little'))
+        self.samples.add(sample)
+
+    def maybe_size(self, size):
+        return size.to_bytes(8, 'little') in self.sizes
+
+    def maybe_sample(self, sample):
+        return sample in self.samples
+
+    def maybe_hash(self, hash_val):
+        return hash_val in self.hashes
+
+def load_dedup_index(conn):
+    count = conn.execute("SELECT COUNT(*) FROM uploaded_files").fetchone()[0]
+    index = DedupIndex(count)
+    for hash_val, size, sample, algorithm in conn.execute("SELECT file_hash, size, sample_hash, hash_algo FROM uploaded_files"):
+        index.add(hash_val, size, sample, algorithm)
+    return index
+
+def candidate_algorithms(conn, size, sample):
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT hash_algo FROM uploaded_files WHERE size=? AND sample_hash=?", (size, sample))
+    return {row[0] for row in cursor.fetchall()}
+
+def backfill_upload_keys(conn, hash_val, size, sample):
+    conn.execute("UPDATE uploaded_files SET size=?, sample_hash=COALESCE(sample_hash, ?) WHERE file_hash=? AND (size IS NULL OR sample_hash IS NULL)",
+                 (size, sample, hash_val))
+
+def mark_uploaded(conn, hash_val, smb_path, size, sample, algorithm, original_name):
+    # Returns False when another worker already recorded the same content.
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM in_progress_uploads WHERE smb_path=?", (smb_path,))
+    cursor.execute("INSERT OR IGNORE INTO uploaded_files (file_hash, size, sample_hash, hash_algo, original_name, remote_path, uploaded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (hash_val, size, sample, algorithm, original_name, smb_path, time.time()))
+    return cursor.rowcount == 1
+
+def begin_upload(conn, smb_path, tmp_path, hash_val, entry):
+    conn.execute("INSERT OR REPLACE INTO in_progress_uploads (smb_path, file_hash, tmp_path, volume_id, rel_path, size, mtime, committed_offset, chunk_hash, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 0, NULL, ?)",
+                 (smb_path, hash_val, tmp_path, entry['volume_id'], entry['rel_path'], entry['size'], entry['mtime'], time.time()))
+
+def checkpoint_upload(conn, smb_path, offset, chunk_hash):
+    conn.execute("UPDATE in_progress_uploads SET committed_offset=?, chunk_hash=?, updated_at=? WHERE smb_path=?", (offset, chunk_hash, time.time(), smb_path))
+
+def find_resumable(conn, entry, root):
+    cursor = conn.cursor()
+    cursor.execute("SELECT smb_path, tmp_path, committed_offset, chunk_hash FROM in_progress_uploads WHERE volume_id=? AND rel_path=? AND size=? AND mtime=? AND tmp_path IS NOT NULL "
+                   "AND substr(smb_path, 1, length(?)) = ?", (entry['volume_id'], entry['rel_path'], entry['size'], entry['mtime'], root + '/', root + '/'))
+    return cursor.fetchone()
+
+def load_in_progress(conn, root):
+    return conn.execute("SELECT smb_path, tmp_path, updated_at FROM in_progress_uploads WHERE substr(smb_path, 1, length(?)) = ?", (root + '/', root + '/')).fetchall()
+
+def record_copies(conn, hash_val, copies):
+    conn.executemany("INSERT OR REPLACE INTO destination_copies (destination, file_hash, remote_path, done) VALUES (?, ?, ?, ?)",
+                     ((root, hash_val, path, done) for root, path, done in copies))
+
+def mark_copied(conn, root, hash_val):
+    conn.execute("UPDATE destination_copies SET done=1 WHERE destination=? AND file_hash=?", (root, hash_val))
+
+def load_pending_copies(conn, root):
+    return conn.execute("SELECT c.file_hash, u.hash_algo, c.remote_path, s.destination, s.remote_path FROM destination_copies c "
+                        "JOIN destination_copies s ON s.file_hash = c.file_hash AND s.done = 1 JOIN uploaded_files u ON u.file_hash = c.file_hash "
+                        "WHERE c.destination=? AND c.done=0", (root,)).fetchall()
+
+def path_recorded(conn, paths, file_hash=None):
+    # True when a partial upload or another file's copy already uses one of paths.
+    marks = ','.join('?' * len(paths))
+    return conn.execute(f"SELECT 1 FROM in_progress_uploads WHERE smb_path IN ({marks}) UNION ALL "
+                        f"SELECT 1 FROM destination_copies WHERE remote_path IN ({marks}) AND file_hash IS NOT ? LIMIT 1",
+                        (*paths, *paths, file_hash)).fetchone() is not None
+
+def clear_in_progress(conn, smb_paths):
+    conn.executemany("DELETE FROM in_progress_uploads WHERE smb_path=?", ((smb_path,) for smb_path in smb_paths))
+
+# Partial uploads are kept for resuming. Only rows from before resumable
+# uploads (written straight to the final name) and temporary files nobody has
+# touched for RESUME_MAX_AGE_DAYS are removed.
+def cleanup_incomplete_uploads(destination):
+    db = get_db()
+    expired = time.time() - RESUME_MAX_AGE_DAYS * 86400
+    stale = []
+    for smb_path, tmp_path, updated_at in db.call(load_in_progress, destination.root):
+        if tmp_path is not None and (updated_at or 0) >= expired:
+            continue
+        try:
+            destination.remove(tmp_path or smb_path)
+        except Exception:
+            pass
+        stale.append(smb_path)
+    db.call(clear_in_progress, stale, durable=True)
+
+# --- SHARE MANIFEST ---
+# The share keeps its own list of what it holds, so a cleared database, a
+# reinstall or a second station does not upload everything again. The file
+# at MANIFEST_PATH is a header followed by fixed-size records (algorithm id,
+# size, sample hash, digest padded to 32 bytes) and is only ever appended to.
+# A session reads just the part it has not imported yet, nothing at all when
+# the size and mtime match the last read, and imports it into uploaded_files,
+# where the usual dedup tiers find it. New uploads are appended in batches.
+MANIFEST_MAGIC = b"SDUPMAN1"
+MANIFEST_RECORD = struct.Struct('<BQ16s32s')
+MANIFEST_ALGORITHMS = {'sha256': 1, 'blake2b': 2, 'xxh3': 3}
+MANIFEST_DIGEST_SIZES = {'sha256': 32, 'blake2b': 32, 'xxh3': 16}
+
+def manifest_record(hash_val, size, sample, algorithm):
+    return MANIFEST_RECORD.pack(MANIFEST_ALGORITHMS[algorithm], size, sample, hash_val)
+
+def parse_manifest_records(data):
+    names = {number: name for name, number in MANIFEST_ALGORITHMS.items()}
+    rows = []
+    for algorithm_id, size, sample, digest in MANIFEST_RECORD.iter_unpack(data):
+        algorithm = names.get(algorithm_id)
+        if algorithm:
+            rows.append((digest[:MANIFEST_DIGEST_SIZES[algorithm]], size, sample, algorithm))
+    return rows
+
+def load_manifest_state(conn, path):
+    return conn.execute("SELECT size, mtime, imported FROM remote_manifests WHERE path=?", (path,)).fetchone()
+
+def import_manifest_records(conn, path, rows, size, mtime, imported):
+    # Returns how many records were new to this database.
+    added = conn.executemany("INSERT OR IGNORE INTO uploaded_files (file_hash, size, sample_hash, hash_algo) VALUES (?, ?, ?, ?)", rows).rowcount
+    conn.execute("INSERT OR REPLACE INTO remote_manifests (path, size, mtime, imported) VALUES (?, ?, ?, ?)", (path, size, mtime, imported))
+    return added
+
+def manifest_seed_rows(conn):
+    return conn.execute("SELECT file_hash, size, sample_hash, hash_algo FROM uploaded_files WHERE size IS NOT NULL AND sample_hash IS NOT NULL").fetchall()
+
+class ShareManifest:
+    def __init__(self, destination, log_func):
+        self.destination = destination
+        self.log_func = log_func
+        self.path = destination.join(MANIFEST_PATH)
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def sync(self, db, metrics):
+        # Returns how many files were new to the local database. Without the
+        # manifest, dedup still works from the local database alone.
+        try:
+            with metrics.timed('smb_open'):
+                stat = self.destination.stat(self.path)
+            if stat is None:
+                self.create(db)
+                return 0
+            size, mtime = stat
+            state = metrics.db_call(db, load_manifest_state, self.path)
+            if state is not None and (state[0], state[1]) == (size, mtime):
+                return 0
+            # The file only grows; if it shrank it was replaced, so read it all.
+            start = state[2] if state is not None and state[2] <= size else 0
+            with metrics.timed('smb_open', size - start):
+                data = self.destination.read_range(self.path, start, size - start)
+            if start == 0:
+                if data[:len(MANIFEST_MAGIC)] != MANIFEST_MAGIC:
+                    self.log_func(f"⚠️ Ignoring {self.path}: not a manifest this version understands")
+                    return 0
+                data = data[len(MANIFEST_MAGIC):]
+                start = len(MANIFEST_MAGIC)
+            # A record still being appended is picked up next time.
+            whole = len(data) - len(data) % MANIFEST_RECORD.size
+            rows = parse_manifest_records(data[:whole])
+            return metrics.db_call(db, import_manifest_records, self.path, rows, size, mtime, start + whole, durable=True)
+        except Exception as e:
+            self.log_func(f"⚠️ Share manifest unavailable: {e}")
+            return 0
+
+    def create(self, db):
+        # Seeded with everything this station already knows. Creation is
+        # exclusive, so when two stations race, the loser appends instead.
+        rows = db.call(manifest_seed_rows)
+        data = MANIFEST_MAGIC + b"".join(manifest_record(*row) for row in rows if row[3] in MANIFEST_ALGORITHMS)
+        self.destination.makedirs(self.path.rsplit('/', 1)[0])
+        try:
+            self.destination.write_new(self.path, data)
+        except FileExistsError:
+            return
+
+    def add(self, hash_val, size, sample, algorithm):
+        with self.lock:
+            self.pending.append(manifest_record(hash_val, size, sample, algorithm))
+            if len(self.pending) < MANIFEST_BATCH:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.pending = self.pending, []
+        if not records:
+            return
+        try:
+            self.destination.append(self.path, b"".join(records))
+        except Exception as e:
+            # Kept for the next flush; a missing record only costs a dedup hit.
+            with self.lock:
+                self.pending = records + self.pending
+            self.log_func(f"⚠️ Could not update share manifest: {e}")
+
+# --- DUPLICATE DETECTION ---
+# Most files on a card are new, so each tier only runs when the cheaper one
+# before it could not rule the file out: size, then the head/tail sample hash,
+# then the full content hash in whichever algorithms the candidate rows use.
+def classify_entry(db, entry, index, metrics):
+    algorithm = hash_algorithm()
+    # Rows from before sizes and samples were stored only match by content
+    # hash. Until they are all backfilled every new file is hashed here, once
+    # thanks to the hash cache, so a duplicate of one never reaches the share.
+    algorithms = set(index.legacy_algorithms)
+    if index.maybe_size(entry['size']):
+        with metrics.timed('hash', min(entry['size'], 2 * SAMPLE_BLOCK)):
+            entry['sample'] = sample_hash(entry['path'], entry['size'])
+        if entry['sample'] is None:
+            return 'error'
+        if index.maybe_sample(entry['sample']):
+            # Rows from another station may use an algorithm this one cannot compute.
+            algorithms |= {a for a in metrics.db_call(db, candidate_algorithms, entry['size'], entry['sample']) if hash_available(a)}
+    if not algorithms:
+        return 'pending'
+    with metrics.timed('hash', entry['size']):
+        hashes = file_hashes(entry['path'], algorithms | {algorithm})
+    if hashes is None:
+        return 'error'
+    entry['hash'] = hashes[algorithm]
+    db.submit(store_hash_cache, entry['volume_id'], entry['rel_path'], entry['size'], entry['mtime'], entry['hash'], algorithm)
+    matches = metrics.db_call(db, filter_uploaded, [hashes[a] for a in algorithms if index.maybe_hash(hashes[a])])
+    if matches and entry['sample'] is None:
+        entry['sample'] = sample_hash(entry['path'], entry['size'])
+    for hash_val in matches:
+        db.submit(backfill_upload_keys, hash_val, entry['size'], entry['sample'])
+    return 'skipped' if matches else 'pending'
+
+# --- CARD SCAN ---
+# One walk of the card builds the manifest that every later stage works from:
+# counters, the space check, the storage label and the upload workers.
+def make_entry(sd_mount, volume_id, local_path, stat, cache):
+    rel_path = os.path.relpath(local_path, sd_mount).replace("\\", "/")
+    file = os.path.basename(local_path)
+    return {
+        'path': local_path,
+        'file': file,
+        'volume_id': volume_id,
+        'rel_path': rel_path,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'ext': Path(file).suffix.upper(),
+        'hash': lookup_hash_cache(cache, rel_path, stat.st_size, stat.st_mtime),
+        'sample': None,
+        'status': 'pending',
+    }
+
+def scan_card(sd_mount, db, index, log_func, metrics, dirs=None, unsettled=None):
+    manifest = []
+    cached_entries = []
+    volume_id = get_volume_id(sd_mount)
+    scan_started = time.time()
+    cache = metrics.db_call(db, load_hash_cache, volume_id, hash_algorithm())
+    for root, _, files in os.walk(sd_mount):
+        if dirs is not None:
+            # Directory mtimes let watch mode find new files without walking again
+            try:
+                dirs[root] = os.stat(root).st_mtime
+            except OSError:
+                pass
+        for file in files:
+            ext = Path(file).suffix.upper()
+            if not ALLOWED_EXTENSIONS.get(ext, False):
+                continue
+            local_path = str((Path(root) / file).resolve())
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                continue
+            if unsettled is not None and scan_started - stat.st_mtime < WATCH_STABLE_SECONDS + WATCH_MTIME_SLACK:
+                # May still be being written; watch mode queues it once it holds still.
+                unsettled.append(local_path)
+                continue
+            entry = make_entry(sd_mount, volume_id, local_path, stat, cache)
+            if entry['hash'] is not None:
+                cached_entries.append(entry)
+            else:
+                # New files are left unhashed; the upload stream hashes them.
+                entry['status'] = classify_entry(db, entry, index, metrics)
+                if entry['status'] == 'error':
+                    log_func(f"❌ Cannot read file: {local_path}")
+            manifest.append(entry)
+
+    # Files with a cached hash are checked against the index in one batch.
+    uploaded = metrics.db_call(db, filter_uploaded, [entry['hash'] for entry in cached_entries if index.maybe_hash(entry['hash'])])
+    for entry in cached_entries:
+        if entry['hash'] in uploaded:
+            entry['status'] = 'skipped'
+            if index.legacy_algorithms:
+                db.submit(backfill_upload_keys, entry['hash'], entry['size'], sample_hash(entry['path'], entry['size']))
+    db.submit(touch_hash_cache, volume_id, [entry['rel_path'] for entry in cached_entries], scan_started)
+    db.submit(prune_hash_cache, volume_id, scan_started)
+    metrics.record('scan', time.time() - scan_started)
+    return manifest
+
+# --- WATCH MODE ---
+# With WATCH_MODE on, a session keeps the card open after the first pass and
+# feeds new shots to the same scheduler. Only directories are polled: a file
+# appearing changes its directory's mtime, so unchanged directories are never
+# listed again. FAT keeps mtimes to two seconds, so a directory touched within
+# WATCH_MTIME_SLACK is listed on every poll until it settles. A new file is
+# queued once its size and mtime have held still for WATCH_STABLE_SECONDS,
+# and so is any file the first pass found modified within the last few
+# seconds, which the camera may still have been writing. Every poll also yields None, so the scheduler can pick up retries and close
+# a batch while the card sits idle. Pulling the card ends the session.
+class CardWatch:
+    def __init__(self, sd_mount, dirs, manifest, unsettled=()):
+        self.sd_mount = sd_mount
+        self.dirs = dict(dirs)
+        self.seen = {entry['path'] for entry in manifest}
+        self.candidates = dict.fromkeys(unsettled)
+
+    def list_dir(self, path):
+        try:
+            with os.scandir(path) as it:
+                for item in it:
+                    if item.is_dir(follow_symlinks=False):
+                        self.dirs.setdefault(item.path, None)
+                    elif ALLOWED_EXTENSIONS.get(Path(item.name).suffix.upper(), False):
+                        local_path = str(Path(item.path).resolve())
+                        if local_path not in self.seen:
+                            self.candidates.setdefault(local_path, None)
+        except OSError:
+            self.dirs.pop(path, None)
+
+    def poll(self):
+        now = time.time()
+        for path, last_mtime in list(self.dirs.items()):
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self.dirs.pop(path, None)
+                continue
+            self.dirs[path] = mtime
+            if mtime != last_mtime or now - mtime < WATCH_MTIME_SLACK:
+                self.list_dir(path)
+
+        stable = []
+        for local_path, last in list(self.candidates.items()):
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                del self.candidates[local_path]
+                continue
+            key = (stat.st_size, stat.st_mtime)
+            if last is None or last[0] != key:
+                self.candidates[local_path] = (key, now)
+            elif now - last[1] >= WATCH_STABLE_SECONDS:
+                del self.candidates[local_path]
+                self.seen.add(local_path)
+                stable.append((local_path, stat))
+        return stable
+
+def watch_card(sd_mount, dirs, manifest, unsettled, db, index, log_func, counters, update_storage_func, metrics, cancel_event):
+    watch = CardWatch(sd_mount, dirs, manifest, unsettled)
+    volume_id = get_volume_id(sd_mount)
+    log_func("👀 Watching card for new files.")
+    while not cancel_event.wait(WATCH_INTERVAL):
+        found = []
+        for local_path, stat in watch.poll():
+            entry = make_entry(sd_mount, volume_id, local_path, stat, {})
+            entry['status'] = classify_entry(db, entry, index, metrics)
+            manifest.append(entry)
+            if entry['status'] == 'error':
+                log_func(f"❌ Cannot read file: {local_path}")
+            elif entry['status'] == 'skipped':
+                counters.add(skipped=1)
+            else:
+                counters.add(detected=1, remaining=1, bytes_total=entry['size'])
+                found.append(entry)
+        if found:
+            update_storage_func(manifest)
+        yield from found
+        yield None
+
+# --- PROGRESS ---
+# Upload threads post progress here and never touch the window. The window
+# reads a snapshot on its own timer, so a burst of small files costs a lock
+# per file instead of a widget refresh per file. bytes_done counts whole
+# files that are finished or skipped plus the chunks of files in flight;
+# a failed file takes its chunks back out. bytes_sent only ever grows and
+# counts what actually crossed the network, which is what the ETA rate uses.
+class Progress:
+    FIELDS = ('detected', 'uploaded', 'remaining', 'skipped', 'failed', 'bytes_total', 'bytes_done', 'bytes_sent')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, **deltas):
+        with self.lock:
+            for key, delta in deltas.items():
+                self.values[key] += delta
+
+    def add_sent(self, entry, nbytes, transferred=True):
+        with self.lock:
+            self.values['bytes_done'] += nbytes
+            self.values['bytes_sent'] += nbytes if transferred else 0
+            entry['sent'] = entry.get('sent', 0) + nbytes
+
+    def finish(self, entry, result):
+        # Settles the byte count for one file so it matches the file result.
+        with self.lock:
+            sent = entry.pop('sent', 0)
+            if result in ('uploaded', 'skipped'):
+                self.values['bytes_done'] += entry['size'] - sent
+            else:
+                self.values['bytes_done'] -= sent
+            self.values['remaining'] -= result != 'retry'
+            if result in ('uploaded', 'skipped', 'failed'):
+                self.values[result] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def __getitem__(self, key):
+        with self.lock:
+            return self.values[key]
+
+# --- METRICS ---
+# Each session times its stages: scan (the card walk), read (card reads),
+# hash, db (waits on the database writer), smb_open (opens, mkdirs and
+# renames on the share), smb_write and verify. A stage keeps a count, bytes,
+# seconds and a latency histogram. When a session ends, and in watch mode
+# after every batch, its totals so far go to METRICS_FILE, as JSON lines
+# (kept across versions) or as Prometheus text (the latest per card, for a
+# textfile collector).
+STAGES = ('scan', 'read', 'hash', 'db', 'smb_open', 'smb_write', 'verify', 'throttle')
+METRIC_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {stage: {'count': 0, 'bytes': 0, 'seconds': 0.0, 'buckets': [0] * (len(METRIC_BUCKETS) + 1)} for stage in STAGES}
+
+    def record(self, stage, seconds, nbytes=0):
+        bucket = bisect.bisect_left(METRIC_BUCKETS, seconds)
+        with self.lock:
+            stats = self.stages[stage]
+            stats['count'] += 1
+            stats['bytes'] += nbytes
+            stats['seconds'] += seconds
+            stats['buckets'][bucket] += 1
+
+    @contextmanager
+    def timed(self, stage, nbytes=0):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start, nbytes)
+
+    def db_call(self, db, func, *args, durable=False):
+        with self.timed('db'):
+            return db.call(func, *args, durable=durable)
+
+    def snapshot(self):
+        with self.lock:
+            return {stage: dict(stats, buckets=list(stats['buckets'])) for stage, stats in self.stages.items()}
+
+# Progress is reported from an exponentially weighted rate of bytes sent, so
+# a 4 GB video and a run of small JPEGs move the ETA by what they cost.
+class RateEstimator:
+    def __init__(self, halflife=ETA_HALFLIFE):
+        self.halflife = halflife
+        self.rate = None
+        self.last = None
+
+    def update(self, total, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last is None or total < self.last[1]:
+            self.last = (now, total)
+            return self.rate
+        elapsed = now - self.last[0]
+        if elapsed < 0.5:
+            return self.rate
+        current = (total - self.last[1]) / elapsed
+        self.last = (now, total)
+        if self.rate is None:
+            # Nothing has moved yet (still scanning); wait for the first bytes.
+            self.rate = current or None
+        else:
+            self.rate += (1 - 0.5 ** (elapsed / self.halflife)) * (current - self.rate)
+        return self.rate
+
+    def eta(self, remaining):
+        return remaining / self.rate if self.rate else None
+
+metrics_lock = threading.Lock()
+latest_metrics = {}
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(records):
+    # Each metric family has to be one contiguous block in the text format.
+    histogram = ["# TYPE sd_uploader_stage_seconds histogram"]
+    stage_bytes = ["# TYPE sd_uploader_stage_bytes_total counter"]
+    files = ["# TYPE sd_uploader_session_files gauge"]
+    seconds = ["# TYPE sd_uploader_session_seconds gauge"]
+    for record in records:
+        labels = f'version="{APP_VERSION}",card="{prometheus_label(record["card"])}"'
+        for stage, stats in record['stages'].items():
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + ('+Inf',), stats['buckets']):
+                cumulative += count
+                histogram.append(f'sd_uploader_stage_seconds_bucket{{{labels},stage="{stage}",le="{bound}"}} {cumulative}')
+            histogram.append(f'sd_uploader_stage_seconds_sum{{{labels},stage="{stage}"}} {stats["seconds"]:.6f}')
+            histogram.append(f'sd_uploader_stage_seconds_count{{{labels},stage="{stage}"}} {stats["count"]}')
+            stage_bytes.append(f'sd_uploader_stage_bytes_total{{{labels},stage="{stage}"}} {stats["bytes"]}')
+        for result in ('uploaded', 'skipped', 'failed', 'cancelled'):
+            files.append(f'sd_uploader_session_files{{{labels},result="{result}"}} {record["summary"][result]}')
+        seconds.append(f'sd_uploader_session_seconds{{{labels}}} {record["duration"]:.3f}')
+    return "\n".join(histogram + stage_bytes + files + seconds) + "\n"
+
+def export_metrics(card_path, summary, metrics):
+    if not METRICS_FILE or summary is None:
+        return
+    record = {
+        'version': APP_VERSION,
+        'card': card_path,
+        'started': datetime.fromtimestamp(metrics.started).isoformat(timespec='seconds'),
+        'duration': time.time() - metrics.started,
+        'summary': {key: summary[key] for key in ('uploaded', 'skipped', 'failed', 'cancelled', 'bytes')},
+        'stages': metrics.snapshot(),
+    }
+    with metrics_lock:
+        if METRICS_FORMAT == 'prometheus':
+            latest_metrics[card_path] = record
+            # Written aside and renamed so a scraper never reads half a file.
+            with open(METRICS_FILE + '.tmp', 'w') as f:
+                f.write(prometheus_text(latest_metrics.values()))
+            os.replace(METRICS_FILE + '.tmp', METRICS_FILE)
+        else:
+            with open(METRICS_FILE, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+
+# --- CARD READER ---
+# One thread reads the card for every upload from it, CHUNK_SIZE at a time
+# with readinto into a fixed pool of READ_AHEAD_BYTES of buffers, so the card
+# sees long sequential reads instead of several workers seeking between
+# files, and memory stays bounded however many files are in flight. The
+# reader stays on the oldest open file while it has room for
+# STREAM_READ_AHEAD ready chunks and only then moves to the next one, so a
+# slow upload does not hold back the files behind it. The upload worker
+# hands each buffer back once its write has completed.
+class ReadStream:
+    def __init__(self, reader, path):
+        self.reader = reader
+        self.path = path
+        self.file = None
+        self.chunks = deque()
+        self.done = False
+        self.closed = False
+        self.error = None
+
+    def next(self):
+        # Returns (buffer, chunk), or None at the end of the file.
+        with self.reader.cond:
+            while not self.chunks and not self.done and self.error is None and not self.reader.stopped:
+                self.reader.cond.wait()
+            if self.chunks:
+                self.reader.cond.notify_all()
+                return self.chunks.popleft()
+            if self.error is not None:
+                raise self.error
+            if not self.done:
+                raise UploadCancelled()
+            return None
+
+    def release(self, buffer):
+        self.reader.release(buffer)
+
+    def close(self):
+        with self.reader.cond:
+            self.closed = True
+            while self.chunks:
+                self.reader.free.append(self.chunks.popleft()[0])
+            self.reader.cond.notify_all()
+
+class CardReader:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        count = max(WRITES_IN_FLIGHT + STREAM_READ_AHEAD, READ_AHEAD_BYTES // CHUNK_SIZE)
+        self.free = [bytearray(CHUNK_SIZE) for _ in range(count)]
+        self.streams = []
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        for stream in self.streams:
+            self.close_file(stream)
+
+    def open(self, path):
+        stream = ReadStream(self, path)
+        with self.cond:
+            self.streams.append(stream)
+            self.cond.notify_all()
+        return stream
+
+    def release(self, buffer):
+        with self.cond:
+            self.free.append(buffer)
+            self.cond.notify_all()
+
+    def close_file(self, stream):
+        if stream.file is not None:
+            stream.file.close()
+            stream.file = None
+
+    def next_stream(self):
+        # Called with the lock held: drops finished streams and returns the
+        # oldest one with room for another chunk.
+        for stream in list(self.streams):
+            if stream.closed or stream.done or stream.error is not None:
+                self.close_file(stream)
+                self.streams.remove(stream)
+            elif len(stream.chunks) < STREAM_READ_AHEAD:
+                return stream
+        return None
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.stopped and not (self.free and (stream := self.next_stream())):
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                buffer = self.free.pop()
+            n, error = 0, None
+            try:
+                if stream.file is None:
+                    stream.file = open(stream.path, 'rb', buffering=0)
+                start = time.monotonic()
+                n = stream.file.readinto(buffer)
+                self.metrics.record('read', time.monotonic() - start, n or 0)
+            except OSError as e:
+                error = e
+            with self.cond:
+                if n and not stream.closed:
+                    stream.chunks.append((buffer, memoryview(buffer)[:n]))
+                else:
+                    self.free.append(buffer)
+                    stream.error = error
+                    stream.done = error is None
+                self.cond.notify_all()
+
+# --- BANDWIDTH ---
+# One token bucket for every byte written to any destination. A write takes
+# its bytes at once and may leave the bucket in debt; the next writer sleeps
+# exactly until the debt is paid, so the link runs at the cap without idling
+# between coarse ticks. Small files (under SMALL_FILE_PRIORITY_BYTES) are
+# served before large ones while both are waiting. The limit comes from the
+# first BANDWIDTH_SCHEDULE rule that matches the current time, else
+# BANDWIDTH_LIMIT, and is looked up again every BANDWIDTH_CHECK_INTERVAL.
+#
+#   "BANDWIDTH_SCHEDULE": [{"days": ["mon", "tue", "wed", "thu", "fri"], "start": "08:00", "end": "18:00", "limit_mbps": 20}]
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+settings_mtime = None
+
+def clock_minutes(value):
+    hours, minutes = (int(part) for part in value.split(':'))
+    if not (0 <= hours <= 24 and 0 <= minutes < 60) or hours * 60 + minutes > 24 * 60:
+        raise ValueError(f"{value} is not a time of day")
+    return hours * 60 + minutes
+
+# Settings are parsed before any log exists, so problems wait here until a
+# front end or a running session passes them to its log.
+settings_warnings = deque()
+
+def take_settings_warnings():
+    messages = []
+    while settings_warnings:
+        messages.append(settings_warnings.popleft())
+    return messages
+
+def parse_bandwidth_schedule(rules):
+    schedule = []
+    for rule in rules:
+        try:
+            days = {day.lower()[:3] for day in rule['days']} if rule.get('days') else None
+            schedule.append((days, clock_minutes(rule['start']), clock_minutes(rule['end']), int(float(rule.get('limit_mbps', 0)) * 1024 * 1024)))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            settings_warnings.append(f"❌ Ignoring bandwidth schedule rule {rule}: {e}")
+    return schedule
+
+def scheduled_limit(now=None):
+    now = now or datetime.now()
+    minute = now.hour * 60 + now.minute
+    for days, start, end, limit in BANDWIDTH_SCHEDULE:
+        if days is not None and WEEKDAYS[now.weekday()] not in days:
+            continue
+        # A rule that ends before it starts runs over midnight.
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return limit
+    return BANDWIDTH_LIMIT
+
+def reload_bandwidth_settings():
+    global settings_mtime
+    try:
+        mtime = os.stat(SETTINGS_FILE).st_mtime
+        if mtime == settings_mtime:
+            return
+        known, settings_mtime = settings_mtime, mtime
+        if known is None:
+            return
+        with open(SETTINGS_FILE, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return
+    apply_bandwidth_settings(data)
+
+class RateLimiter:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.small_waiting = 0
+        self.rate = None
+        self.checked = 0.0
+
+    def current_rate(self):
+        # Called with the lock held.
+        now = time.monotonic()
+        if self.rate is None or now - self.checked >= BANDWIDTH_CHECK_INTERVAL:
+            self.checked = now
+            reload_bandwidth_settings()
+            self.rate = scheduled_limit()
+        return self.rate
+
+    def limit(self):
+        with self.cond:
+            return self.current_rate()
+
+    def acquire(self, nbytes, small=False):
+        # Returns how long the caller was held back.
+        start = time.monotonic()
+        with self.cond:
+            self.small_waiting += small
+            try:
+                while True:
+                    rate = self.current_rate()
+                    now = time.monotonic()
+                    if not rate:
+                        self.tokens, self.updated = 0.0, now
+                        break
+                    self.tokens = min(rate * BANDWIDTH_BURST_SECONDS, self.tokens + (now - self.updated) * rate)
+                    self.updated = now
+                    if self.tokens >= 0 and (small or not self.small_waiting):
+                        self.tokens -= nbytes
+                        break
+                    # Wake when the debt is paid, or sooner to notice a new limit.
+                    delay = -self.tokens / rate if self.tokens < 0 else BANDWIDTH_CHECK_INTERVAL
+                    self.cond.wait(min(delay, BANDWIDTH_CHECK_INTERVAL))
+            finally:
+                self.small_waiting -= small
+                self.cond.notify_all()
+        return time.monotonic() - start
+
+rate_limiter = RateLimiter()
+
+# --- SCHEDULER ---
+# Card reads go through the CardReader; the number of files in flight on the
+# network is tuned. Every TUNE_INTERVAL the limit is nudged one step in its
+# current direction, held while throughput stays flat, and reversed when
+# throughput drops, so a high-latency link gets more files in flight. Files
+# are uploaded smallest class first, and anything over LARGE_FILE_BYTES is
+# streamed on its own at the end.
+class AdaptiveLimit:
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    def __enter__(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+class StageStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.busy = 0.0
+        self.ops = 0
+        self.window_start = time.monotonic()
+
+    def record(self, nbytes, seconds):
+        with self.lock:
+            self.bytes += nbytes
+            self.busy += seconds
+            self.ops += 1
+
+    def sample(self):
+        # Returns (bytes per second, mean seconds per operation) since the last sample.
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.window_start, 1e-6)
+            result = (self.bytes / elapsed, self.busy / self.ops if self.ops else 0.0, self.ops)
+            self.bytes, self.busy, self.ops, self.window_start = 0, 0.0, 0, now
+        return result
+
+class ConcurrencyTuner:
+    def __init__(self, name, gate, stats, maximum):
+        self.name = name
+        self.gate = gate
+        self.stats = stats
+        self.maximum = maximum
+        self.direction = 1
+        self.last_rate = None
+
+    def adjust(self):
+        rate, latency, ops = self.stats.sample()
+        if not ops:
+            return None
+        if self.last_rate is not None and rate < self.last_rate * 0.95:
+            self.direction = -self.direction
+        elif self.last_rate is not None and rate < self.last_rate * 1.05:
+            self.last_rate = rate
+            return None
+        self.last_rate = rate
+        limit = min(self.maximum, max(1, self.gate.limit + self.direction))
+        if limit == self.gate.limit:
+            self.direction = -self.direction
+            return None
+        self.gate.set_limit(limit)
+        return f"⚙️ {self.name}: {limit}/{self.maximum} ({rate / (1024 * 1024):.1f}MB/s, {latency * 1000:.0f}ms/op)"
+
+def upload_order(entry):
+    return (entry['size'] >= LARGE_FILE_BYTES, EXTENSION_ORDER.get(entry['ext'], 1), entry['size'])
+
+class UploadCancelled(Exception):
+    pass
+
+def iter_pending(manifest):
+    return (entry for entry in sorted((entry for entry in manifest if entry['status'] == 'pending'), key=upload_order))
+
+def new_summary():
+    return {'uploaded': 0, 'skipped': 0, 'failed': 0, 'cancelled': 0, 'bytes': 0, 'errors': []}
+
+def batch_results(summary):
+    return summary['uploaded'] + summary['skipped'] + summary['failed'] + summary['cancelled']
+
+class UploadScheduler:
+    def __init__(self, log_func, cancel_event=None, progress=None, metrics=None):
+        self.log_func = log_func
+        self.progress = progress or Progress()
+        self.metrics = metrics or Metrics()
+        self.reader = CardReader(self.metrics)
+        self.net_gate = AdaptiveLimit(max(1, NET_WORKERS // 2))
+        self.write_stats = StageStats()
+        self.tuners = [
+            ConcurrencyTuner("network files", self.net_gate, self.write_stats, NET_WORKERS),
+        ]
+        self.stopped = threading.Event()
+        self.cancelled = cancel_event or threading.Event()
+        self.summary = new_summary()
+        self.batch = new_summary()
+        self.summary_lock = threading.Lock()
+        self.retries = []
+        self.bandwidth = rate_limiter.limit()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise UploadCancelled()
+
+    def record(self, entry, result):
+        self.progress.finish(entry, result)
+        with self.summary_lock:
+            for summary in (self.summary, self.batch):
+                summary[result] += 1
+                if result == 'uploaded':
+                    summary['bytes'] += entry['size']
+                elif result == 'failed':
+                    summary['errors'].append((entry['file'], entry.get('error')))
+
+    def run_one(self, entry, work_func):
+        if self.cancelled.is_set():
+            self.record(entry, 'cancelled')
+            return
+        try:
+            result = work_func(entry)
+        except Exception as e:
+            # upload_file handles its own errors; this only catches bugs, which must not vanish.
+            entry['error'] = str(e)
+            self.log_func(f"❌ Error uploading {entry['file']}: {e}")
+            result = 'failed'
+        if result == 'retry':
+            entry['attempts'] = entry.get('attempts', 0) + 1
+            if entry['attempts'] <= VERIFY_RETRIES:
+                self.progress.finish(entry, result)
+                with self.summary_lock:
+                    self.retries.append(entry)
+                return
+            self.log_func(f"❌ Giving up on {entry['file']} after {entry['attempts']} failed verifications")
+            result = 'failed'
+        self.record(entry, result)
+
+    def take_retries(self):
+        with self.summary_lock:
+            batch, self.retries = self.retries, []
+        return sorted(batch, key=upload_order)
+
+    def take_batch(self):
+        with self.summary_lock:
+            batch, self.batch = self.batch, new_summary()
+        return batch
+
+    def write(self, handle, chunk, offset, entry):
+        waited = rate_limiter.acquire(len(chunk), entry['size'] < SMALL_FILE_PRIORITY_BYTES)
+        if waited > 0.001:
+            self.metrics.record('throttle', waited, len(chunk))
+        start = time.monotonic()
+        handle.write_at(chunk, offset)
+        elapsed = time.monotonic() - start
+        self.write_stats.record(len(chunk), elapsed)
+        self.metrics.record('smb_write', elapsed, len(chunk))
+        self.progress.add_sent(entry, len(chunk))
+
+    def bandwidth_text(self):
+        return f"{self.bandwidth / (1024 * 1024):.1f}MB/s" if self.bandwidth else "unlimited"
+
+    def tune(self):
+        while not self.stopped.wait(TUNE_INTERVAL):
+            for message in take_settings_warnings():
+                self.log_func(message)
+            for tuner in self.tuners:
+                message = tuner.adjust()
+                if message:
+                    self.log_func(message)
+            limit = rate_limiter.limit()
+            if limit != self.bandwidth:
+                self.bandwidth = limit
+                self.log_func(f"⚙️ Upload limit now {self.bandwidth_text()}")
+
+    # Entries come from a generator in upload_order and pass through a bounded
+    # queue, so the feeder blocks while workers are busy. Large files sort
+    # last; the first one closes the worker pool and the rest run inline. In
+    # watch mode small files can follow, and they start the pool again. Files
+    # that fail verification are fed again behind whatever is next; once the
+    # entries run out the queue is drained until no retries are left. A None
+    # entry is an idle tick from watch mode: retries go out, and when nothing
+    # is queued or running the results since the last batch go to on_batch.
+    def run(self, entries, work_func, on_batch=None):
+        self.log_func(f"⚙️ Scheduler: read-ahead {len(self.reader.free)} x {CHUNK_SIZE // (1024 * 1024)}MB, network files {self.net_gate.limit}/{NET_WORKERS}, "
+                      f"{WRITES_IN_FLIGHT} chunks in flight per file, files over {LARGE_FILE_BYTES // (1024 * 1024)}MB streamed alone, upload limit {self.bandwidth_text()}")
+        work = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+
+        def worker():
+            while (entry := work.get()) is not None:
+                with self.net_gate:
+                    self.run_one(entry, work_func)
+                work.task_done()
+            work.task_done()
+
+        workers = []
+
+        def start_pool():
+            workers.extend(threading.Thread(target=worker, daemon=True) for _ in range(NET_WORKERS))
+            for thread in workers:
+                thread.start()
+
+        self.reader.start()
+        start_pool()
+        threading.Thread(target=self.tune, daemon=True).start()
+
+        def close_pool():
+            for _ in workers:
+                work.put(None)
+            for thread in workers:
+                thread.join()
+            workers.clear()
+
+        def feed():
+            for entry in entries:
+                if entry is not None:
+                    yield entry
+                yield from self.take_retries()
+                if entry is None and on_batch and work.unfinished_tasks == 0 and not self.retries:
+                    on_batch(self.take_batch())
+            while True:
+                work.join()
+                batch = self.take_retries()
+                if not batch:
+                    return
+                yield from batch
+
+        try:
+            for entry in feed():
+                large = entry['size'] >= LARGE_FILE_BYTES
+                if large and workers:
+                    close_pool()
+                elif not large and not workers:
+                    start_pool()
+                if not workers:
+                    self.run_one(entry, work_func)
+                    continue
+                while True:
+                    if self.cancelled.is_set():
+                        self.record(entry, 'cancelled')
+                        break
+                    try:
+                        work.put(entry, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+            close_pool()
+        finally:
+            self.stopped.set()
+            self.reader.stop()
+        return self.summary
+
+# --- BACKUP COPIES ---
+# A mirror copy writes the same chunks as the lead upload to another
+# destination's ".part" file. It may trail the lead by WRITES_IN_FLIGHT
+# chunks; past that the lead waits for it out of the session's
+# DESTINATION_LAG_SECONDS budget, and once that runs out the mirror is
+# dropped. Chunk buffers go back to the reader only when every destination
+# has written them.
+copies_in_flight = set()
+copies_lock = threading.Lock()
+catch_up_thread = None
+
+class MirrorCopy:
+    def __init__(self, destinations, destination, path):
+        self.destinations = destinations
+        self.destination = destination
+        self.path = path
+        self.tmp_path = path + ".part"
+        self.handle = None
+        self.futures = deque()
+        self.failed = False
+
+    def open(self, metrics):
+        try:
+            with metrics.timed('smb_open'):
+                self.destination.makedirs(self.path.rsplit('/', 1)[0])
+                self.handle = self.destination.open_write(self.tmp_path)
+        except Exception as e:
+            self.fail(str(e))
+
+    def write_at(self, chunk, offset, metrics):
+        waited = rate_limiter.acquire(len(chunk))
+        if waited > 0.001:
+            metrics.record('throttle', waited, len(chunk))
+        with metrics.timed('smb_write', len(chunk)):
+            self.handle.write_at(chunk, offset)
+
+    def submit(self, chunk, offset, metrics):
+        # Returns the write's future, or None once the mirror is dropped.
+        self.settle(WRITES_IN_FLIGHT)
+        if self.failed:
+            return None
+        future = self.destinations.write_pool(self.destination).submit(self.write_at, chunk, offset, metrics)
+        self.futures.append(future)
+        return future
+
+    def settle(self, keep):
+        while self.futures and not self.failed:
+            if self.futures[0].done():
+                error = self.futures.popleft().exception()
+                if error is not None:
+                    self.fail(str(error))
+                continue
+            if len(self.futures) <= keep:
+                return
+            start = time.monotonic()
+            wait([self.futures[0]], timeout=max(0.0, self.destinations.stall(self.destination, 0.0)))
+            if self.destinations.stall(self.destination, time.monotonic() - start) <= 0 and not self.futures[0].done():
+                self.fail("fell behind")
+
+    def close(self):
+        self.settle(0)
+        if not self.failed:
+            try:
+                self.handle.close()
+            except Exception as e:
+                self.fail(str(e))
+
+    def fail(self, reason):
+        if not self.failed:
+            self.destinations.drop(self.destination, reason)
+            self.discard()
+
+    def discard(self):
+        # Removes the partial copy once its pending writes have finished.
+        if self.failed and self.handle is None:
+            return
+        self.failed = True
+        pending, handle, self.handle = list(self.futures), self.handle, None
+        self.destinations.finish(self.abandon, pending, handle)
+
+    def abandon(self, pending, handle):
+        wait(pending)
+        try:
+            if handle is not None:
+                handle.close()
+            self.destination.remove(self.tmp_path)
+        except Exception:
+            pass
+
+def release_after(stream, buffer, futures):
+    # Hands the buffer back to the reader once every write of it has completed.
+    pending = [future for future in futures if not future.done()]
+    if not pending:
+        stream.release(buffer)
+        return
+    remaining = [len(pending)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = not remaining[0]
+        if last:
+            stream.release(buffer)
+
+    for future in pending:
+        future.add_done_callback(done)
+
+# A copy never replaces a file already on its destination; if the name was
+# taken after the lead claimed it, the copy takes the next free suffix.
+def place_copy(destination, tmp_path, path, hash_val):
+    stem, ext = os.path.splitext(path)
+    for n in itertools.count():
+        candidate = path if n == 0 else f"{stem}_{n}{ext}"
+        if n and get_db().call(path_recorded, [candidate], hash_val):
+            continue
+        try:
+            destination.rename(tmp_path, candidate)
+            return candidate
+        except FileExistsError:
+            continue
+
+def record_copy(destination, hash_val, path, recorded_path):
+    if path == recorded_path:
+        get_db().submit(mark_copied, destination.root, hash_val)
+    else:
+        get_db().submit(record_copies, hash_val, [(destination.root, path, 1)])
+
+def finish_mirror(mirror, entry, hash_val, algorithm, blocks, metrics, log_func):
+    key = (mirror.destination.root, hash_val)
+    try:
+        problem = verify_upload(entry, mirror.destination, mirror.destinations.verify_pool, mirror.tmp_path, hash_val, algorithm, blocks, metrics)
+        if problem:
+            raise OSError(f"verification failed: {problem}")
+        with metrics.timed('smb_open'):
+            path = place_copy(mirror.destination, mirror.tmp_path, mirror.path, hash_val)
+        record_copy(mirror.destination, hash_val, path, mirror.path)
+    except Exception as e:
+        log_func(f"⚠️ Copy of {entry['file']} to {mirror.destination.root} failed: {e}; it will catch up later")
+        try:
+            mirror.destination.remove(mirror.tmp_path)
+        except Exception:
+            pass
+    finally:
+        with copies_lock:
+            copies_in_flight.discard(key)
+
+def record_upload_copies(destinations, hash_val, smb_path, mirrors):
+    # Every destination gets a row; only the lead's copy is done so far.
+    lead = destinations.lead
+    rel_path = smb_path[len(lead.root):]
+    copies = [(destination.root, destination.root + rel_path, destination is lead) for destination in destinations.destinations]
+    with copies_lock:
+        copies_in_flight.update((mirror.destination.root, hash_val) for mirror in mirrors)
+    get_db().submit(record_copies, hash_val, copies)
+
+# Copies a destination missed are filled in from another destination that
+# has them, one file at a time on a background thread, after a session ends.
+# The source is hashed on the way through, so a file that was changed or
+# overwritten on the source is never passed on under the recorded hash.
+def copy_between(source, source_path, target, target_path, file_hash, algorithm):
+    # Returns the path the copy ended up at.
+    tmp_path = target_path + ".part"
+    target.makedirs(target_path.rsplit('/', 1)[0])
+    h = new_hasher(algorithm)
+    try:
+        offset = 0
+        with source.open_read(source_path) as src, target.open_write(tmp_path) as dst:
+            for chunk in read_chunks(src):
+                rate_limiter.acquire(len(chunk))
+                h.update(chunk)
+                dst.write_at(chunk, offset)
+                offset += len(chunk)
+        if h.digest() != file_hash:
+            raise OSError(f"{source_path} no longer matches its recorded hash")
+        if target.getsize(tmp_path) != offset:
+            raise OSError(f"{tmp_path} has the wrong size")
+        return place_copy(target, tmp_path, target_path, file_hash)
+    except Exception:
+        try:
+            target.remove(tmp_path)
+        except Exception:
+            pass
+        raise
+
+def catch_up(destinations, log_func):
+    online = {destination.root: destination for destination in destinations}
+    db = get_db()
+    for target in destinations:
+        copied, failures, seen = 0, 0, set()
+        for file_hash, algorithm, path, source_root, source_path in db.call(load_pending_copies, target.root):
+            source = online.get(source_root)
+            key = (target.root, file_hash)
+            if source is None or source is target or file_hash in seen or not hash_available(algorithm):
+                continue
+            with copies_lock:
+                if key in copies_in_flight:
+                    continue
+                copies_in_flight.add(key)
+            try:
+                copied_path = copy_between(source, source_path, target, path, file_hash, algorithm)
+            except Exception as e:
+                log_func(f"⚠️ Could not copy {source_path} to {target.root}: {e}")
+                failures += 1
+                if failures >= 3:
+                    break
+                continue
+            finally:
+                with copies_lock:
+                    copies_in_flight.discard(key)
+            seen.add(file_hash)
+            record_copy(target, file_hash, copied_path, path)
+            copied += 1
+            failures = 0
+        if copied:
+            log_func(f"🔁 Copied {copied} files that {target.root} missed earlier")
+    flush_db()
+
+def start_catch_up(destinations, log_func):
+    global catch_up_thread
+    if catch_up_thread is None or not catch_up_thread.is_alive():
+        catch_up_thread = threading.Thread(target=catch_up, args=(destinations, log_func), daemon=True)
+        catch_up_thread.start()
+
+# --- FILE UPLOADER ---
+# Each chunk is read from the card once and fed to both the hasher and the
+# remote handle, so the full hash is known the moment the copy finishes.
+# Up to WRITES_IN_FLIGHT chunks per file are written concurrently while the
+# CardReader reads ahead; a buffer is only recycled once its write has
+# completed.
+#
+# Data goes to a temporary ".part" file that is renamed into place at the end.
+# Every RESUME_CHECKPOINT_BYTES the pipeline drains and the offset reached,
+# plus a digest of the SAMPLE_BLOCK bytes before it, is recorded in
+# in_progress_uploads.
+#
+# Before the rename the copy is checked according to VERIFY_MODE: "size"
+# compares the remote length, "sampled" also reads back VERIFY_SAMPLES random
+# blocks whose digests were taken from the card as they were uploaded, and
+# "full" reads the whole file back and hashes it. The read-back runs on the
+# file's own worker, so other uploads carry on meanwhile. A file that fails
+# is deleted from the share and queued again, up to VERIFY_RETRIES times.
+def verify_resume_point(destination, tmp_path, offset, chunk_hash, local_path):
+    # The block before the committed offset must match on both the share and
+    # the card; only that block crosses the network.
+    if not offset or chunk_hash is None:
+        return False
+    try:
+        if destination.getsize(tmp_path) < offset:
+            return False
+        length = min(SAMPLE_BLOCK, offset)
+        with open(local_path, 'rb') as f:
+            f.seek(offset - length)
+            local_block = f.read(length)
+        remote_block = destination.read_range(tmp_path, offset - length, length)
+        return chunk_digest(local_block) == chunk_hash and chunk_digest(remote_block) == chunk_hash
+    except Exception:
+        return False
+
+def stream_upload(entry, destination, pool, tmp_path, algorithm, scheduler, resume_offset=0, mirrors=()):
+    h = new_hasher(algorithm)
+    sample = SampleCollector(entry['size'])
+    blocks = BlockSampler(entry['size'], VERIFY_SAMPLES if VERIFY_MODE == 'sampled' else 0)
+    metrics = scheduler.metrics
+    # The hasher state cannot be stored, so a resumed upload re-reads the
+    # prefix from the card; only the share side is skipped.
+    stream = scheduler.reader.open(entry['path'])
+    in_flight = deque()
+    offset = 0
+    last_checkpoint = resume_offset
+
+    def settle():
+        buffer, future, copies = in_flight.popleft()
+        try:
+            future.result()
+        finally:
+            release_after(stream, buffer, [future] + copies)
+
+    try:
+        with metrics.timed('smb_open'):
+            dst = destination.open_write(tmp_path, resume=resume_offset > 0)
+        for mirror in mirrors:
+            mirror.open(metrics)
+        with dst:
+            try:
+                while True:
+                    while len(in_flight) >= WRITES_IN_FLIGHT:
+                        settle()
+                    scheduler.check_cancelled()
+                    item = stream.next()
+                    if item is None:
+                        break
+                    buffer, chunk = item
+                    with metrics.timed('hash', len(chunk)):
+                        h.update(chunk)
+                        sample.update(chunk, offset)
+                        blocks.update(chunk, offset)
+                    skip = min(max(resume_offset - offset, 0), len(chunk))
+                    if skip < len(chunk):
+                        future = pool.submit(scheduler.write, dst, chunk[skip:], offset + skip, entry)
+                        copies = [mirror.submit(chunk[skip:], offset + skip, metrics) for mirror in mirrors]
+                        in_flight.append((buffer, future, [copy for copy in copies if copy is not None]))
+                    else:
+                        stream.release(buffer)
+                    offset += len(chunk)
+                    if offset - last_checkpoint >= RESUME_CHECKPOINT_BYTES:
+                        chunk_hash = chunk_digest(chunk[-SAMPLE_BLOCK:])
+                        while in_flight:
+                            settle()
+                        get_db().submit(checkpoint_upload, entry['smb_path'], offset, chunk_hash)
+                        last_checkpoint = offset
+            finally:
+                # Never close the handle (or recycle the buffers) under a pending write.
+                wait([future for _, future, _ in in_flight])
+            while in_flight:
+                settle()
+        for mirror in mirrors:
+            mirror.close()
+    finally:
+        for buffer, future, copies in in_flight:
+            release_after(stream, buffer, [future] + copies)
+        stream.close()
+    if offset < resume_offset:
+        raise OSError(f"{entry['file']} is shorter than its resume point")
+    return h.digest(), sample.digest(), blocks.samples()
+
+def verify_upload(entry, destination, pool, tmp_path, hash_val, algorithm, blocks, metrics):
+    # Returns what is wrong with the remote copy, or None when it checks out.
+    if VERIFY_MODE == 'off':
+        return None
+    with metrics.timed('verify'):
+        size = destination.getsize(tmp_path)
+    if size != entry['size']:
+        return f"remote size is {size} bytes, expected {entry['size']}"
+    if VERIFY_MODE == 'sampled':
+        with metrics.timed('verify', sum(length for _, length, _ in blocks)):
+            reads = [pool.submit(destination.read_range, tmp_path, start, length) for start, length, _ in blocks]
+            for (start, _, digest), read in zip(blocks, reads):
+                if chunk_digest(read.result()) != digest:
+                    return f"block at offset {start} differs from the card"
+    elif VERIFY_MODE == 'full':
+        h = new_hasher(algorithm)
+        with metrics.timed('verify', size), destination.open_read(tmp_path) as f:
+            for chunk in read_chunks(f):
+                h.update(chunk)
+        if h.digest() != hash_val:
+            return "content differs from the card"
+    return None
+
+def skip_upload(entry, log_func):
+    log_func(f"⏭️ Skipping (already uploaded): {entry['file']}")
+    entry['status'] = 'skipped'
+    return 'skipped'
+
+claimed_paths = set()
+claimed_lock = threading.Lock()
+
+# Cameras restart numbering in every card folder (100MSDCF/DSC00001.JPG,
+# 101MSDCF/DSC00001.JPG), so a name gets a numbered suffix when it is taken
+# on any destination: on a reachable share, by another partial upload, by a
+# copy still owed to an offline destination or by a worker in this session.
+# Names are claimed relative to the destination roots.
+def claim_remote_path(destinations, remote_folder, file, metrics):
+    db = get_db()
+    lead = destinations.lead
+    online = [lead] + destinations.active_mirrors()
+    folder = remote_folder[len(lead.root):]
+    stem, ext = os.path.splitext(file)
+    for n in itertools.count():
+        rel_path = f"{folder}/{file}" if n == 0 else f"{folder}/{stem}_{n}{ext}"
+        with claimed_lock:
+            if rel_path in claimed_paths:
+                continue
+            claimed_paths.add(rel_path)
+        with metrics.timed('smb_open'):
+            taken = any(destination.stat(destination.root + rel_path) is not None for destination in online)
+        if not taken and not metrics.db_call(db, path_recorded, [destination.root + rel_path for destination in destinations.destinations]):
+            return rel_path
+        with claimed_lock:
+            claimed_paths.discard(rel_path)
+
+def upload_file(entry, destinations, remote_folder, log_func, index, scheduler, share_manifest):
+    file = entry['file']
+    local_path = entry['path']
+    destination = destinations.lead
+    db = get_db()
+    metrics = scheduler.metrics
+    mirrors = []
+    claimed = None
+    try:
+        if entry['hash'] is not None and index.maybe_hash(entry['hash']) and metrics.db_call(db, already_uploaded, entry['hash']):
+            return skip_upload(entry, log_func)
+
+        resume_offset = 0
+        resumable = metrics.db_call(db, find_resumable, entry, destination.root)
+        if resumable:
+            # Resume into the folder the upload started in, even on a later day.
+            smb_path, tmp_path, offset, chunk_hash = resumable
+            with metrics.timed('verify', SAMPLE_BLOCK):
+                verified = verify_resume_point(destination, tmp_path, offset, chunk_hash, local_path)
+            if verified:
+                resume_offset = offset
+                scheduler.progress.add_sent(entry, offset, transferred=False)
+        else:
+            claimed = claim_remote_path(destinations, remote_folder, file, metrics)
+            smb_path = destination.root + claimed
+            tmp_path = smb_path + ".part"
+        entry['smb_path'] = smb_path
+
+        if not resume_offset:
+            # The in-progress row must be committed before any remote bytes exist,
+            # so cleanup_incomplete_uploads can find the partial file after a crash.
+            metrics.db_call(db, begin_upload, smb_path, tmp_path, entry['hash'], entry, durable=True)
+            # A resumed upload has no prefix on the mirrors; they catch up later instead.
+            mirrors = [MirrorCopy(destinations, mirror, mirror.root + smb_path[len(destination.root):]) for mirror in destinations.active_mirrors()]
+
+        with metrics.timed('smb_open'):
+            destination.makedirs(smb_path.rsplit('/', 1)[0])
+        if resume_offset:
+            log_func(f"📤 Resuming {local_path} to {smb_path} at {resume_offset / (1024 * 1024):.1f}MB")
+        else:
+            log_func(f"📤 Uploading {local_path} to {smb_path}")
+        algorithm = hash_algorithm()
+        hash_val, entry['sample'], blocks = stream_upload(entry, destination, destinations.write_pool(destination), tmp_path, algorithm, scheduler, resume_offset, mirrors)
+        if entry['hash'] is not None and hash_val != entry['hash']:
+            log_func(f"⚠️ {file} changed since it was scanned")
+        entry['hash'] = hash_val
+        db.submit(store_hash_cache, entry['volume_id'], entry['rel_path'], entry['size'], entry['mtime'], hash_val, algorithm)
+
+        problem = verify_upload(entry, destination, destinations.verify_pool, tmp_path, hash_val, algorithm, blocks, metrics)
+        if problem:
+            log_func(f"⚠️ Verification failed for {file}: {problem}")
+            entry['error'] = f"verification failed: {problem}"
+            # Start over from byte 0: the bad data may sit before the last checkpoint.
+            with metrics.timed('smb_open'):
+                destination.remove(tmp_path)
+            metrics.db_call(db, clear_in_progress, [smb_path], durable=True)
+            return 'retry'
+        with metrics.timed('smb_open'):
+            destination.replace(tmp_path, smb_path)
+
+        # Same content can appear twice on one card; the first copy to finish wins.
+        if not metrics.db_call(db, mark_uploaded, hash_val, smb_path, entry['size'], entry['sample'], algorithm, file):
+            if metrics.db_call(db, uploaded_path, hash_val) != smb_path:
+                with metrics.timed('smb_open'):
+                    destination.remove(smb_path)
+            return skip_upload(entry, log_func)
+        index.add(hash_val, entry['size'], entry['sample'])
+        share_manifest.add(hash_val, entry['size'], entry['sample'], algorithm)
+        if len(destinations.destinations) > 1:
+            copied = [mirror for mirror in mirrors if not mirror.failed]
+            record_upload_copies(destinations, hash_val, smb_path, copied)
+            for mirror in copied:
+                destinations.finish(finish_mirror, mirror, entry, hash_val, algorithm, blocks, metrics, log_func)
+            mirrors = []
+
+        entry['status'] = 'uploaded'
+        log_func(f"✅ Uploaded: {file}")
+        return 'uploaded'
+    except UploadCancelled:
+        log_func(f"⏹️ Cancelled: {file}")
+        return 'cancelled'
+    except Exception as e:
+        log_func(f"❌ Error uploading {file}: {e}")
+        entry['error'] = str(e)
+        return 'failed'
+    finally:
+        for mirror in mirrors:
+            mirror.discard()
+        if claimed:
+            with claimed_lock:
+                claimed_paths.discard(claimed)
+
+def log_summary(summary, log_func, title="Session"):
+    log_func(f"📋 {title} summary: {summary['uploaded']} uploaded ({summary['bytes'] / (1024 * 1024):.1f}MB), "
+             f"{summary['skipped']} skipped, {summary['failed']} failed, {summary['cancelled']} cancelled")
+    for file, error in summary['errors']:
+        log_func(f"   ❌ {file}: {error}")
+
+def upload_files(sd_mount, log_func, counters, update_storage_func, destinations=None, cancel_event=None, metrics=None, on_batch=None):
+    destinations = DestinationSet(destinations or get_destinations(), log_func)
+    init_db()
+    destinations.connect()
+    destination = destinations.lead
+    cleanup_incomplete_uploads(destination)
+    date_folder = datetime.now().strftime("%Y-%m-%d")
+    remote_folder = destination.join(date_folder)
+
+    metrics = metrics or Metrics()
+    db = get_db()
+    share_manifest = ShareManifest(destination, log_func)
+    imported = share_manifest.sync(db, metrics)
+    if imported:
+        log_func(f"📒 Learned {imported} files already on the share from its manifest")
+    index = metrics.db_call(db, load_dedup_index)
+    dirs = {}
+    unsettled = [] if WATCH_MODE else None
+    manifest = scan_card(sd_mount, db, index, log_func, metrics, dirs, unsettled)
+
+    pending = [entry for entry in manifest if entry['status'] == 'pending']
+    counters.add(detected=len(pending), remaining=len(pending), bytes_total=sum(entry['size'] for entry in pending),
+                 skipped=sum(1 for entry in manifest if entry['status'] == 'skipped'))
+    update_storage_func(manifest)
+
+    total_upload_size = get_total_upload_size(manifest)
+    smb_free = destination.free_space(remote_folder)
+
+    if smb_free < total_upload_size:
+        log_func("❌ Not enough space on SMB share to upload files.")
+        return None
+
+    cancel_event = cancel_event or threading.Event()
+    entries = iter_pending(manifest)
+    if WATCH_MODE:
+        entries = itertools.chain(entries, watch_card(sd_mount, dirs, manifest, unsettled, db, index, log_func, counters, update_storage_func, metrics, cancel_event))
+    scheduler = UploadScheduler(log_func, cancel_event, counters, metrics)
+
+    def settle():
+        destinations.wait()
+        share_manifest.flush()
+        flush_db()
+
+    def finish(summary, title):
+        log_summary(summary, log_func, title)
+        export_metrics(sd_mount, scheduler.summary, metrics)
+        if len(destinations.destinations) > 1:
+            # Dropped mirrors included: catching up runs in the background.
+            start_catch_up(destinations.connected, log_func)
+
+    # In watch mode each batch is settled while the card waits for more shots.
+    def batch_done(batch):
+        if batch_results(batch):
+            settle()
+            finish(batch, "Batch")
+        if on_batch:
+            on_batch(batch)
+
+    try:
+        summary = scheduler.run(entries, lambda entry: upload_file(entry, destinations, remote_folder, log_func, index, scheduler, share_manifest), batch_done)
+    finally:
+        settle()
+        destinations.close()
+    finish(summary, "Session")
+    return summary
+
+# --- LOGGING ---
+# The window keeps the last LOG_RING_LINES lines in a ring; every line also
+# goes to a rotating file. Callers only put a record on a queue, and a
+# QueueListener thread does the file writes, so a slow disk never holds up
+# an upload thread.
+class LogRing:
+    def __init__(self, maxlen):
+        self.lines = deque(maxlen=maxlen)
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def append(self, line):
+        with self.lock:
+            self.lines.append(line)
+            self.seq += 1
+
+    def since(self, seq):
+        # Returns (latest seq, lines after seq); lines already rotated out are gone.
+        with self.lock:
+            count = min(self.seq - seq, len(self.lines))
+            return self.seq, list(itertools.islice(self.lines, len(self.lines) - count, None)) if count > 0 else []
+
+file_log = logging.getLogger("sd_uploader")
+log_listener = None
+
+def start_file_log():
+    global log_listener
+    if log_listener is not None:
+        return
+    handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    log_queue = queue.SimpleQueue()
+    file_log.addHandler(QueueHandler(log_queue))
+    file_log.setLevel(logging.INFO)
+    file_log.propagate = False
+    log_listener = QueueListener(log_queue, handler)
+    log_listener.start()
+
+def stop_file_log():
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+# --- CARD DETECTION ---
+# A watcher reports card paths appearing and disappearing through on_insert and
+# on_remove. On Linux the kernel flags /proc/self/mounts with POLLPRI whenever
+# the mount table changes, so a card mounted by udisks or systemd is seen as
+# soon as it is mounted. Everywhere else the configured paths are polled.
+def card_paths():
+    paths = []
+    for path in [SD_LABEL] + SD_LABELS:
+        if path and path not in paths:
+            paths.append(path)
+    return paths
+
+def unescape_mount_path(field):
+    # /proc/self/mounts escapes spaces, tabs and newlines as octal (\040)
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+class DeviceWatcher:
+    def __init__(self, paths_func, on_insert, on_remove):
+        self.paths_func = paths_func
+        self.on_insert = on_insert
+        self.on_remove = on_remove
+        self.present = set()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def is_present(self, path):
+        return os.path.isdir(path)
+
+    def check(self):
+        paths = self.paths_func()
+        for path in paths:
+            present = self.is_present(path)
+            if present and path not in self.present:
+                self.present.add(path)
+                self.on_insert(path)
+            elif not present and path in self.present:
+                self.present.discard(path)
+                self.on_remove(path)
+        # A path dropped from the settings counts as removed
+        for path in self.present - set(paths):
+            self.present.discard(path)
+            self.on_remove(path)
+
+class PollingWatcher(DeviceWatcher):
+    def run(self):
+        while not self.stopped.is_set():
+            self.check()
+            self.stopped.wait(CARD_POLL_INTERVAL)
+
+class LinuxMountWatcher(DeviceWatcher):
+    def __init__(self, paths_func, on_insert, on_remove):
+        super().__init__(paths_func, on_insert, on_remove)
+        self.mounts = set()
+
+    def is_present(self, path):
+        # The mount point directory outlives the card, so a path only counts
+        # while a filesystem is mounted on it; one that merely lies inside
+        # another mount (/home, /srv, /run) is an empty reader.
+        path = os.path.normpath(path)
+        return path != '/' and path in self.mounts and os.path.isdir(path)
+
+    def read_mounts(self, f):
+        f.seek(0)
+        self.mounts = {unescape_mount_path(line.split()[1]) for line in f.read().splitlines() if len(line.split()) > 1}
+
+    def run(self):
+        with open('/proc/self/mounts') as f:
+            poller = select.poll()
+            poller.register(f, select.POLLPRI | select.POLLERR)
+            while not self.stopped.is_set():
+                # Re-reading the table clears the pending event
+                self.read_mounts(f)
+                self.check()
+                # The timeout only bounds how long stop() and settings changes take to apply
+                poller.poll(CARD_POLL_INTERVAL * 1000)
+
+def create_watcher(on_insert, on_remove):
+    if CARD_WATCHER != 'poll' and hasattr(select, 'poll') and os.path.exists('/proc/self/mounts'):
+        return LinuxMountWatcher(card_paths, on_insert, on_remove)
+    return PollingWatcher(card_paths, on_insert, on_remove)
+
+# --- INGEST SESSIONS ---
+# Every card gets its own session: its own counters, manifest, scheduler and
+# cancel event, so cards in separate readers ingest side by side. Sessions
+# share the destination, the database writer and the uploaded_files table,
+# which is what keeps a photo on two cards from being uploaded twice.
+class IngestSession:
+    def __init__(self, card_path, log_func, update_storage_func):
+        self.card_path = card_path
+        self.log_func = log_func
+        self.update_storage_func = update_storage_func
+        self.counters = Progress()
+        self.metrics = Metrics()
+        self.manifest = []
+        self.cancel_event = threading.Event()
+        self.state = 'scanning'
+        self.summary = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def log(self, message):
+        self.log_func(f"[{self.card_path}] {message}")
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def set_manifest(self, manifest):
+        self.manifest = manifest
+        self.state = 'uploading'
+        self.update_storage_func()
+
+    def batch_done(self, batch):
+        if self.state != 'watching':
+            self.state = 'watching'
+            self.update_storage_func()
+
+    def run(self):
+        try:
+            self.summary = upload_files(self.card_path, self.log, self.counters, self.set_manifest, cancel_event=self.cancel_event, metrics=self.metrics,
+                                        on_batch=self.batch_done)
+        except Exception as e:
+            self.state = 'failed'
+            self.log(f"❌ Upload failed: {e}")
+        else:
+            # In watch mode pulling the card is how a session ends; it only
+            # counts as cancelled when it cut an upload short.
+            if self.cancel_event.is_set() and not (WATCH_MODE and self.summary is not None and not self.summary['cancelled']):
+                self.state = 'cancelled'
+            elif self.summary is None or self.summary['failed']:
+                self.state = 'failed'
+            else:
+                self.state = 'done'
+                self.log("✅ Upload complete.")
+
+# --- HEADLESS ---
+# The same watcher and sessions as the window, without it, for an ingest box
+# or a service manager. Log lines go to stdout and the log file. Every
+# interval a status line is printed, or, with a status file, a JSON document
+# replaces it (written aside and renamed, so readers never see half of one).
+def headless_status(sessions, rate):
+    totals = dict.fromkeys(Progress.FIELDS, 0)
+    cards = []
+    for session in sessions:
+        counters = session.counters.snapshot()
+        for key, value in counters.items():
+            totals[key] += value
+        cards.append(dict(counters, card=session.card_path, state=session.state))
+    speed = rate.update(totals['bytes_sent'])
+    remaining = max(0, totals['bytes_total'] - totals['bytes_done'])
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'version': APP_VERSION,
+        'cards': cards,
+        'totals': totals,
+        'rate': speed or 0.0,
+        'eta': rate.eta(remaining) if remaining else 0,
+    }
+
+def status_line(status):
+    if not status['cards']:
+        return "📊 Waiting for a card"
+    cards = " | ".join(f"{card['card']} {card['state']} {card['uploaded']}/{card['detected']} uploaded, {card['skipped']} skipped" for card in status['cards'])
+    totals = status['totals']
+    eta = time.strftime('%H:%M:%S', time.gmtime(status['eta'])) if status['eta'] is not None else "calculating"
+    return (f"📊 {cards} | {totals['bytes_done'] / (1024 * 1024):.1f}/{totals['bytes_total'] / (1024 * 1024):.1f}MB "
+            f"at {status['rate'] / (1024 * 1024):.1f}MB/s, ETA {eta}")
+
+def write_status_file(path, status):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f, indent=4)
+    os.replace(path + '.tmp', path)
+
+def run_headless(status_file=None, interval=STATUS_INTERVAL):
+    load_settings()
+    start_file_log()
+    sessions = {}
+    sessions_lock = threading.Lock()
+    stopped = threading.Event()
+
+    def log(message):
+        print(f"{datetime.now().strftime('%H:%M:%S')} - {message}", flush=True)
+        file_log.info(message)
+
+    def card_inserted(card_path):
+        session = IngestSession(card_path, log, lambda: None)
+        with sessions_lock:
+            sessions[card_path] = session
+        log(f"SD card detected at {card_path}")
+        session.start()
+
+    def card_removed(card_path):
+        with sessions_lock:
+            session = sessions.pop(card_path, None)
+        if session is not None and session.is_alive():
+            if session.state == 'watching':
+                log(f"SD card removed from {card_path}, watch ended.")
+            else:
+                log(f"⏹️ SD card removed from {card_path}, cancelling pending uploads.")
+            session.cancel()
+        else:
+            log(f"SD card removed from {card_path}.")
+
+    for message in take_settings_warnings():
+        log(message)
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    watcher = create_watcher(card_inserted, card_removed)
+    watcher.start()
+    log(f"Watching {', '.join(card_paths())} for cards")
+    rate = RateEstimator()
+    try:
+        while not stopped.wait(interval):
+            with sessions_lock:
+                active = list(sessions.values())
+            status = headless_status(active, rate)
+            if status_file:
+                write_status_file(status_file, status)
+            else:
+                print(status_line(status), flush=True)
+    finally:
+        log("Stopping.")
+        watcher.stop()
+        with sessions_lock:
+            active = list(sessions.values())
+        for session in active:
+            session.cancel()
+        for session in active:
+            session.thread.join(timeout=30)
+        flush_db()
+        stop_file_log()
@@ -0,0 +1,372 @@
+import json
+import os
+import sys
+import threading
+import time
+import signal
+from datetime import datetime
+import tkinter as tk
+from tkinter import ttk, messagebox, Toplevel, StringVar, BooleanVar, Checkbutton
+import pystray
+from PIL import Image, ImageDraw
+import smbclient
+import sd_engine as engine
+from sd_engine import (Progress, RateEstimator, IngestSession, LogRing, create_watcher, file_log, start_file_log, stop_file_log,
+                       flush_db, clear_db, get_local_free_space, get_total_upload_size, estimate_smb_free_space)
+
+# The window and tray icon. Settings live in sd_engine, so they are read and
+# changed there as engine.NAME; everything else comes from the engine as is.
+UI_FPS = 10
+
+def check_for_updates(auto=False):
+    import urllib.request, shutil, os, sys, subprocess, tempfile
+    try:
+        with urllib.request.urlopen("https://tlogi.xyz/sd_uploader_version.txt", timeout=5) as response:
+            latest_version = response.read().decode().strip()
+        if latest_version != engine.APP_VERSION:
+            result = messagebox.askyesno("Update Available", f"Version {latest_version} is available. Download and apply now?")
+            if result:
+                exe_path = sys.executable if getattr(sys, 'frozen', False) else os.path.abspath(sys.argv[0])
+                new_path = exe_path + ".new"
+                pid = os.getpid()
+
+                with urllib.request.urlopen("https://tlogi.xyz/sd_uploader_latest.exe", timeout=10) as r, open(new_path, "wb") as f:
+                    shutil.copyfileobj(r, f)
+
+                messagebox.showinfo("Update Downloaded", "The app will now restart to apply the update.")
+
+                bat_script = f"""@echo off
+taskkill /PID {pid} /F >nul
+timeout /t 4 >nul
+del "{exe_path}" >nul 2>&1
+move "{new_path}" "{exe_path}"
+timeout /t 2 >nul
+start "" "{exe_path}"
+del "%~f0"
+"""
+                bat_path = os.path.join(tempfile.gettempdir(), "update_sd_uploader.bat")
+                with open(bat_path, "w") as bat_file:
+                    bat_file.write(bat_script)
+
+                subprocess.Popen(["cmd", "/c", bat_path], shell=True)
+                return
+    except Exception as e:
+        if not auto:
+            messagebox.showerror("Update Failed", f"Could not complete update:\\n{e}")
+
+class UploadApp:
+    def __init__(self, root):
+        self.root = root
+        self.root.title("SD Card Uploader")
+        self.root.geometry("300x200")
+        self.root.configure(bg="#2e2e2e")
+
+        style = ttk.Style(self.root)
+        style.theme_use('clam')
+        style.configure('.', background='#2e2e2e', foreground='white', fieldbackground='#3a3a3a')
+        style.configure('TButton', background='#444', foreground='white')
+        style.configure('TLabel', background='#2e2e2e', foreground='white')
+        style.configure('Horizontal.TProgressbar', troughcolor='#444', background='#00ff00')
+
+
+        self.sd_status_label = ttk.Label(root, text="SD Card: Not Detected")
+        self.sd_status_label.pack(pady=5)
+        self.settings_button = ttk.Button(root, text="Settings", command=self.open_settings)
+        self.settings_button.pack(pady=5)
+
+        self.log_button = ttk.Button(root, text="View Log", command=self.open_log)
+        self.log_button.pack(pady=5)
+
+        self.status_label = ttk.Label(root, text="Files Detected: 0 | Uploaded: 0 | Remaining: 0")
+        self.status_label.pack(pady=5)
+
+        self.eta_label = ttk.Label(root, text="Estimated Time Remaining: N/A")
+        self.eta_label.pack(pady=2)
+
+        self.storage_label = ttk.Label(root, text="Storage: SD=0MB | SMB=∞MB")
+        self.storage_label.pack(pady=2)
+
+        self.progress = ttk.Progressbar(root, orient="horizontal", length=400, mode="determinate")
+        self.progress.pack(pady=10)
+        self.status_label.pack_forget()
+        self.eta_label.pack_forget()
+        self.storage_label.pack_forget()
+        self.progress.pack_forget()
+
+        self.log_ring = LogRing(engine.LOG_RING_LINES)
+
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+        self.widgets_shown = False
+        self.last_frame = None
+        self.rate = RateEstimator()
+        self.storage_text = self.storage_label.cget('text')
+
+        self.tray_icon = None
+        self.setup_tray()
+
+        self.watcher = create_watcher(self.card_inserted, self.card_removed)
+        self.watcher.start()
+
+        self.root.protocol("WM_DELETE_WINDOW", self.minimize_to_tray)
+        threading.Thread(target=lambda: check_for_updates(True), daemon=True).start()
+        self.render()
+
+    def log(self, message):
+        timestamp = f"{datetime.now().strftime('%H:%M:%S')} - {message}"
+        self.log_ring.append(timestamp)
+        file_log.info(message)
+
+    def active_sessions(self):
+        with self.sessions_lock:
+            return list(self.sessions.values())
+
+    # Widgets are only touched here, on the Tk thread, UI_FPS times a second.
+    # A frame is skipped when nothing it would show has changed.
+    def render(self):
+        try:
+            self.update_status()
+        finally:
+            self.root.after(int(1000 / UI_FPS), self.render)
+
+    def update_status(self):
+        sessions = self.active_sessions()
+        totals = dict.fromkeys(Progress.FIELDS, 0)
+        for session in sessions:
+            for key, value in session.counters.snapshot().items():
+                totals[key] += value
+        rate = self.rate.update(totals['bytes_sent'])
+        cards = tuple((session.card_path, session.state) for session in sessions)
+        # The ETA moves with the clock, so the frame key includes the second.
+        frame = (cards, tuple(totals.values()), self.storage_text, int(time.time()))
+        if frame == self.last_frame:
+            return
+        self.last_frame = frame
+
+        if sessions and not self.widgets_shown:
+            self.status_label.pack(pady=5)
+            self.eta_label.pack(pady=2)
+            self.storage_label.pack(pady=2)
+            self.progress.pack(pady=10)
+        elif not sessions and self.widgets_shown:
+            self.status_label.pack_forget()
+            self.eta_label.pack_forget()
+            self.storage_label.pack_forget()
+            self.progress.pack_forget()
+        self.widgets_shown = bool(sessions)
+
+        if totals['bytes_total'] > 0:
+            percent = min(100, (totals['bytes_done'] / totals['bytes_total']) * 100)
+            self.progress['value'] = percent
+            percent_text = f"{percent:.1f}%"
+            remaining = max(0, totals['bytes_total'] - totals['bytes_done'])
+            eta = self.rate.eta(remaining)
+            if not remaining:
+                eta_text = "Done"
+            elif eta is not None:
+                eta_text = f"{time.strftime('%H:%M:%S', time.gmtime(eta))} at {rate / (1024 * 1024):.1f}MB/s"
+            else:
+                eta_text = "Calculating..."
+        else:
+            self.progress['value'] = 0
+            percent_text = "0%"
+            eta_text = "N/A"
+
+        if sessions:
+            self.sd_status_label.config(text="SD Card: " + " | ".join(f"{path} {state}" for path, state in cards))
+        else:
+            self.sd_status_label.config(text="SD Card: Not Detected")
+        failed_text = f" | Failed: {totals['failed']}" if totals['failed'] else ""
+        self.status_label.config(
+            text=f"Files Detected: {totals['detected']} | Uploaded: {totals['uploaded']} | Skipped: {totals['skipped']}{failed_text} | Remaining: {totals['remaining']} "
+                 f"({totals['bytes_done'] / (1024 * 1024):.1f}/{totals['bytes_total'] / (1024 * 1024):.1f}MB, {percent_text})"
+        )
+        self.eta_label.config(text=f"Estimated Time Remaining: {eta_text}")
+        self.storage_label.config(text=self.storage_text)
+
+    def update_storage(self):
+        # Free space on the share costs a round trip, so it is measured off the
+        # Tk thread and shown by the next frame.
+        threading.Thread(target=self.refresh_storage, daemon=True).start()
+
+    def refresh_storage(self):
+        sessions = self.active_sessions()
+        try:
+            sd_free = sum(get_local_free_space(session.card_path) for session in sessions) / (1024 * 1024)
+            total_upload_size = sum(get_total_upload_size(session.manifest) for session in sessions) / (1024 * 1024)
+        except Exception:
+            sd_free, total_upload_size = 0, 0
+
+        try:
+            smb_path = f"//{engine.SMB_SERVER}/{engine.SMB_SHARE}"
+            smb_free = estimate_smb_free_space(smb_path) / (1024 * 1024)
+        except:
+            smb_free = float("inf")
+
+        self.storage_text = f"Storage: SD Free={sd_free:.1f}MB | To Upload={total_upload_size:.1f}MB | SMB Free={smb_free:.1f}MB"
+
+    def card_inserted(self, card_path):
+        session = IngestSession(card_path, self.log, self.update_storage)
+        with self.sessions_lock:
+            self.sessions[card_path] = session
+        self.log(f"SD card detected at {card_path}")
+        session.start()
+
+    def card_removed(self, card_path):
+        with self.sessions_lock:
+            session = self.sessions.pop(card_path, None)
+        if session is not None and session.is_alive():
+            if session.state == 'watching':
+                self.log(f"SD card removed from {card_path}, watch ended.")
+            else:
+                self.log(f"⏹️ SD card removed from {card_path}, cancelling pending uploads.")
+            session.cancel()
+        else:
+            self.log(f"SD card removed from {card_path}.")
+        self.update_storage()
+
+    def open_settings(self):
+        settings_win = Toplevel(self.root, bg="#2e2e2e")
+        settings_win.title("Settings")
+
+        def add_entry(label, var, row):
+            ttk.Label(settings_win, text=label).grid(row=row, column=0, sticky='e')
+            ttk.Entry(settings_win, textvariable=var).grid(row=row, column=1, sticky='w')
+
+        sd_var = StringVar(value=engine.SD_LABEL)
+        sd_label_var = StringVar(value=engine.SD_LABEL)
+        server_var = StringVar(value=engine.SMB_SERVER)
+        share_var = StringVar(value=engine.SMB_SHARE)
+        user_var = StringVar(value=engine.SMB_USER)
+        pass_var = StringVar(value=engine.SMB_PASS)
+
+        add_entry("SD Label:", sd_var, 0)
+        add_entry("SD Label:", sd_label_var, 0)
+        add_entry("SMB Server:", server_var, 1)
+        add_entry("SMB Share:", share_var, 2)
+        add_entry("Username:", user_var, 3)
+        add_entry("Password:", pass_var, 4)
+
+        ext_vars = {}
+        for i, ext in enumerate(engine.ALLOWED_EXTENSIONS):
+            var = BooleanVar(value=engine.ALLOWED_EXTENSIONS[ext])
+            Checkbutton(settings_win, text=ext, variable=var, bg="#2e2e2e", fg="white", selectcolor="#444").grid(row=4 + i, columnspan=2, sticky='w')
+            ext_vars[ext] = var
+
+        limit_var = StringVar(value=f"{engine.BANDWIDTH_LIMIT / (1024 * 1024):g}")
+        add_entry("Upload limit MB/s (0 = none):", limit_var, 9)
+
+        def save_settings():
+            try:
+                limit_mbps = float(limit_var.get() or 0)
+            except ValueError:
+                messagebox.showerror("Settings", f"Upload limit must be a number: {limit_var.get()}")
+                return
+            engine.SD_LABEL = sd_var.get()
+            engine.SD_LABEL = sd_label_var.get()
+            engine.SMB_SERVER = server_var.get()
+            engine.SMB_SHARE = share_var.get()
+            engine.SMB_USER = user_var.get()
+            engine.SMB_PASS = pass_var.get()
+            for ext, var in ext_vars.items():
+                engine.ALLOWED_EXTENSIONS[ext] = var.get()
+            response = os.system(f'ping -n 1 {server_var.get()} >nul')
+            if response != 0:
+                messagebox.showerror("Ping Failed", f"Cannot reach SMB server: {server_var.get()}")
+                return
+            try:
+                smbclient.register_session(server=server_var.get(), username=user_var.get(), password=pass_var.get())
+            except Exception as e:
+                messagebox.showerror("Connection Failed", f"Failed to connect to SMB server: {e}")
+                return
+            # Keep settings that have no field in this window, such as HASH_ALGORITHM.
+            try:
+                with open(engine.SETTINGS_FILE, 'r') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                data = dict(engine.DEFAULT_SETTINGS)
+            data.update({
+                'SD_LABEL': sd_var.get(),
+                'SMB_SERVER': server_var.get(),
+                'SMB_SHARE': share_var.get(),
+                'SMB_USER': user_var.get(),
+                'SMB_PASS': pass_var.get(),
+                'ALLOWED_EXTENSIONS': {ext: var.get() for ext, var in ext_vars.items()},
+                'BANDWIDTH_LIMIT_MBPS': limit_mbps
+            })
+            with open(engine.SETTINGS_FILE, 'w') as f:
+                json.dump(data, f, indent=4)
+            messagebox.showinfo("Settings", "Settings updated.")
+            settings_win.destroy()
+
+        def clear_database():
+            clear_db()
+            messagebox.showinfo("Database", "Photo database cleared.")
+
+        ttk.Label(settings_win, text=f"Version: 1.0.4").grid(row=12, columnspan=2, pady=(10, 0))
+        ttk.Button(settings_win, text="Check for Updates", command=check_for_updates).grid(row=13, columnspan=2, pady=5)
+        ttk.Button(settings_win, text="Save", command=save_settings).grid(row=10, columnspan=2, pady=10)
+        ttk.Button(settings_win, text="Clear Photo Database", command=clear_database).grid(row=11, columnspan=2, pady=5)
+
+    def open_log(self):
+        log_win = Toplevel(self.root)
+        log_win.title("Log Console")
+        log_console = tk.Text(log_win, width=100, height=25, bg="#1e1e1e", fg="white")
+        log_console.pack()
+
+        shown = 0
+
+        # Only lines newer than the last tick are inserted, and the widget is
+        # trimmed to the ring size, so each tick costs the new lines only.
+        def update_log(last_seq=0):
+            nonlocal shown
+            if not log_win.winfo_exists():
+                return
+            seq, lines = self.log_ring.since(last_seq)
+            if lines:
+                at_end = log_console.yview()[1] >= 1.0
+                log_console.insert(tk.END, ("\n" if shown else "") + "\n".join(lines))
+                shown += len(lines)
+                if shown > engine.LOG_RING_LINES:
+                    log_console.delete("1.0", f"{shown - engine.LOG_RING_LINES + 1}.0")
+                    shown = engine.LOG_RING_LINES
+                if at_end:
+                    log_console.see(tk.END)
+            log_win.after(500, update_log, seq)
+
+        update_log()
+
+    def minimize_to_tray(self):
+        self.root.withdraw()
+        self.tray_icon.visible = True
+
+    def restore_window(self, icon=None, item=None):
+        self.root.deiconify()
+        self.tray_icon.visible = False
+
+    def setup_tray(self):
+        icon_image = Image.new('RGB', (64, 64), color='white')
+        draw = ImageDraw.Draw(icon_image)
+        draw.rectangle([16, 16, 48, 48], fill='black')
+
+        menu = pystray.Menu(pystray.MenuItem("Open", self.restore_window), pystray.MenuItem("Quit", self.quit_app))
+        self.tray_icon = pystray.Icon("Uploader", icon_image, "SD Uploader", menu)
+        threading.Thread(target=self.tray_icon.run, daemon=True).start()
+
+    def quit_app(self):
+        self.watcher.stop()
+        flush_db()
+        stop_file_log()
+        self.tray_icon.stop()
+        self.root.quit()
+        os._exit(0)
+
+def run_gui():
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    engine.load_settings()
+    start_file_log()
+    root = tk.Tk()
+    app = UploadApp(root)
+    for message in engine.take_settings_warnings():
+        app.log(message)
+    root.mainloop()